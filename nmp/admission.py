@@ -0,0 +1,163 @@
+#!/bin/env python3
+
+'''
+Admission control for the nmp server:
+
+   --max-tunnels 4096         # concurrent tcp/mux streams and udp pipes
+   --max-connects 256         # upstream connects in flight
+   --client-max-tunnels 256   # concurrent tunnels per client ip
+   --admission-queue 128      # requests waiting for a slot, default 128
+   --trusted-proxies 127.0.0.1,::1   # client ip from X-Forwarded-For/X-Real-IP
+
+Over a limit a request waits up to a second in a fifo queue for a free
+slot. Once the queue is full or the wait is over it is rejected at once
+with NMP_CONNECT_OVERLOADED. The clients then give that endpoint a break
+and fail fast, so a spike sheds load instead of slowing down everybody.
+The per client limit never waits. With --workers every worker has its
+own limits.
+
+Behind a reverse proxy (the Caddy setup of the README) every client
+comes from the proxy address, list it in --trusted-proxies or all
+clients share one per client limit. Only websockets from these
+addresses are trusted with the headers, frame port clients never are.
+'''
+
+import asyncio
+import ipaddress
+from collections import deque
+from nmp.log import get_logger
+from nmp.metrics import ADMISSION_ACTIVE, ADMISSIONS
+
+logger = get_logger(__name__)
+
+ADMISSION_QUEUE = 2 ** 7
+ADMISSION_TIMEOUT = 1
+
+
+def parse_proxies(value):
+    # 'ADDRESS[/PREFIX],...' -> networks
+    if not value:
+        return ()
+    return tuple(ipaddress.ip_network(proxy.strip(), strict=False) for proxy in value.split(','))
+
+
+def is_trusted(address, proxies):
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in proxy for proxy in proxies)
+
+
+def client_ip(wsock, proxies=()):
+    address = wsock.remote_address
+    ip = address[0] if address else None
+    headers = getattr(wsock, 'request_headers', None)
+    if not proxies or headers is None or not is_trusted(ip, proxies):
+        return ip
+    # the rightmost address the trusted proxies did not add themselves
+    forwarded = [a.strip() for h in headers.get_all('X-Forwarded-For') for a in h.split(',')]
+    for address in reversed(forwarded):
+        if not is_trusted(address, proxies):
+            return address
+    real_ip = headers.get_all('X-Real-IP')
+    return real_ip[-1].strip() if real_ip else ip
+
+
+class Limiter:
+    # a semaphore with a bounded queue, 0 is unlimited
+    def __init__(self, name, limit, queue=ADMISSION_QUEUE, timeout=ADMISSION_TIMEOUT):
+        self.name = name
+        self.limit = limit
+        self.queue = queue
+        self.timeout = timeout
+        self.active = 0
+        self.waiters = deque()
+        self.gauge = ADMISSION_ACTIVE.labels(name)
+        self.admitted = ADMISSIONS.labels(name, 'admitted')
+        self.queued = ADMISSIONS.labels(name, 'queued')
+        self.rejected = ADMISSIONS.labels(name, 'rejected')
+
+    async def acquire(self):
+        if not self.limit:
+            return True
+        if self.active < self.limit and not self.waiters:
+            self.active += 1
+            self.gauge.inc()
+            self.admitted.inc()
+            return True
+        if len(self.waiters) >= self.queue:
+            self.rejected.inc()
+            return False
+
+        self.queued.inc()
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        try:
+            # release() hands its slot over by completing the waiter
+            await asyncio.wait_for(waiter, self.timeout)
+            self.admitted.inc()
+            return True
+        except asyncio.TimeoutError:
+            # wait_for() may time out on a waiter release() already handed the slot
+            if waiter.done() and not waiter.cancelled():
+                self.admitted.inc()
+                return True
+            self.rejected.inc()
+            return False
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+        finally:
+            try:
+                self.waiters.remove(waiter)
+            except ValueError:
+                pass
+
+    def release(self):
+        if not self.limit:
+            return
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+        self.gauge.dec()
+
+
+class Admission:
+    def __init__(self, config):
+        self.tunnels = Limiter('tunnels', config.max_tunnels, config.admission_queue)
+        self.connects = Limiter('connects', config.max_connects, config.admission_queue)
+        self.client_limit = config.client_max_tunnels
+        self.proxies = parse_proxies(config.trusted_proxies)
+        # client ip -> tunnels
+        self.clients = {}
+        self.client_rejected = ADMISSIONS.labels('client', 'rejected')
+
+    async def admit(self, client):
+        if self.client_limit:
+            if self.clients.get(client, 0) >= self.client_limit:
+                self.client_rejected.inc()
+                return False
+            # counted while waiting, a client can't fill the queue alone
+            self.clients[client] = self.clients.get(client, 0) + 1
+        if await self.tunnels.acquire():
+            return True
+        self.release_client(client)
+        return False
+
+    def release(self, client):
+        self.tunnels.release()
+        self.release_client(client)
+
+    def release_client(self, client):
+        if not self.client_limit:
+            return
+        count = self.clients.get(client, 0) - 1
+        if count > 0:
+            self.clients[client] = count
+        else:
+            self.clients.pop(client, None)
@@ -0,0 +1,120 @@
+#!/bin/env python3
+
+import random
+import time
+from urllib.parse import urlsplit
+from nmp.log import get_logger
+from nmp.metrics import ENDPOINT_FAILURES, ENDPOINT_LATENCY, ENDPOINT_OUTSTANDING, ENDPOINT_OVERLOADS, ENDPOINT_QUARANTINED
+
+logger = get_logger(__name__)
+
+BALANCE_MODES = ('ewma', 'least-conn')
+EWMA_WEIGHT = 0.3
+QUARANTINE_DELAY = 1
+QUARANTINE_MAX_DELAY = 60
+OVERLOAD_DELAY = 1
+OVERLOAD_MAX_DELAY = 30
+
+
+class Endpoint:
+    def __init__(self, url):
+        self.url = url
+        parts = urlsplit(url)
+        self.scheme = parts.scheme
+        self.hostname = parts.hostname
+        # handshake latency, None until the first handshake
+        self.latency = None
+        self.failure_rate = 0.0
+        self.failures = 0
+        self.outstanding = 0
+        self.quarantined_until = 0
+        # the server is up but turns tunnels away
+        self.overloads = 0
+        self.overloaded_until = 0
+
+    def available(self, now):
+        return self.quarantined_until <= now
+
+    def cost(self, mode):
+        if mode == 'least-conn':
+            return self.outstanding
+        # peak ewma, the latency we expect once the queued tunnels are served
+        return (self.latency or 0) * (self.outstanding + 1)
+
+    def succeeded(self, latency):
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += EWMA_WEIGHT * (latency - self.latency)
+        self.failure_rate *= 1 - EWMA_WEIGHT
+        self.failures = 0
+        self.quarantined_until = 0
+        ENDPOINT_LATENCY.labels(self.url).set(self.latency)
+        ENDPOINT_QUARANTINED.labels(self.url).set(0)
+
+    def failed(self):
+        self.failure_rate += EWMA_WEIGHT * (1 - self.failure_rate)
+        self.failures += 1
+        delay = min(QUARANTINE_DELAY * 2 ** (self.failures - 1), QUARANTINE_MAX_DELAY)
+        self.quarantined_until = time.monotonic() + delay
+        logger.warning('endpoint %s quarantined for %ss after %s failures',
+                       self.url, delay, self.failures)
+        ENDPOINT_FAILURES.labels(self.url).inc()
+        ENDPOINT_QUARANTINED.labels(self.url).set(1)
+
+    def overloaded(self):
+        now = time.monotonic()
+        if self.overloaded_until > now:
+            # replies to tunnels opened before the back off started
+            return
+        self.overloads += 1
+        delay = min(OVERLOAD_DELAY * 2 ** (self.overloads - 1), OVERLOAD_MAX_DELAY)
+        # clients turned away together shouldn't all come back together
+        delay *= random.uniform(0.5, 1)
+        self.overloaded_until = now + delay
+        logger.warning('endpoint %s overloaded, back off for %.1fs', self.url, delay)
+        ENDPOINT_OVERLOADS.labels(self.url).inc()
+
+    def accepted(self):
+        self.overloads = 0
+
+    def opened(self, wsock):
+        self.outstanding += 1
+        ENDPOINT_OUTSTANDING.labels(self.url).set(self.outstanding)
+        wsock.connection_lost_waiter.add_done_callback(self.closed)
+
+    def closed(self, _):
+        self.outstanding -= 1
+        ENDPOINT_OUTSTANDING.labels(self.url).set(self.outstanding)
+
+
+class Balancer:
+    def __init__(self, urls, mode='ewma'):
+        self.endpoints = [Endpoint(url.strip().rstrip('/')) for url in urls.split(',') if url.strip()]
+        self.mode = mode
+
+    def pick(self, exclude=()):
+        now = time.monotonic()
+        # overloaded endpoints asked for a break, failing fast beats piling on
+        candidates = [e for e in self.endpoints if e not in exclude and e.overloaded_until <= now]
+        if not candidates:
+            return None
+        available = [e for e in candidates if e.available(now)]
+        if not available:
+            # everything is quarantined, retry whichever recovers first
+            return min(candidates, key=lambda e: e.quarantined_until)
+        if len(available) == 1:
+            return available[0]
+        # power of two choices spreads load without herding on the best one
+        a, b = random.sample(available, 2)
+        return a if a.cost(self.mode) <= b.cost(self.mode) else b
+
+    def backing_off(self):
+        now = time.monotonic()
+        return all(e.overloaded_until > now for e in self.endpoints)
+
+    def stats(self):
+        return [{'url': e.url, 'latency': e.latency, 'failure_rate': e.failure_rate,
+                 'outstanding': e.outstanding, 'quarantined': e.quarantined_until > time.monotonic(),
+                 'overloaded': e.overloaded_until > time.monotonic()}
+                for e in self.endpoints]
@@ -0,0 +1,942 @@
+#!/bin/env python3
+
+'''
+Loopback benchmark suite, nothing leaves 127.0.0.1.
+
+   $ nmp bench --output base.json
+   $ nmp bench --baseline base.json --tolerance 10
+   $ nmp bench --bench memory --modes nmp --idle 100000 --listeners 4 --memory-budget 65536
+   $ nmp bench --bench throughput,latency --modes nmp --transport frame --tls
+
+100k idle tunnels need a RLIMIT_NOFILE hard limit above 300k, every
+tunnel holds client, server and echo sockets.
+
+The NmpServer and the targets (tcp echo/source/sink, udp echo) run in a
+child process, the sockv5/tproxy clients and the load generator in
+another one, once per event loop in --loops. Every result carries a
+'metric' and 'value' pair which --baseline compares with a previous run.
+'''
+
+import argparse
+import asyncio
+import copy
+import gc
+import json
+import os
+import platform
+import random
+import resource
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import websockets
+from nmp.compression import COMPRESSION_MODES, compression_options, install_policy
+from nmp.connection import ConnectionPool
+from nmp.main import Config
+from nmp.metrics import COALESCE_FRAMES, DEFLATE_BYTES, HANDSHAKE_SECONDS, TLS_HANDSHAKES
+from nmp.pipe import STREAM_TYPES, Pipe, SocketStream
+from nmp.proto import NMP_TCP_PIPE_IP
+from nmp.server import NmpServer
+from nmp.shaper import Shaper
+from nmp.sockv5 import UDP_IPV4_HEADER, SockV5Server
+from nmp.transparent import MAX_BACKLOG, UDP_RCVBUF, DatagramHandler, StreamHandler, TransparentServer
+
+CHUNK_SIZE = 2 ** 16
+SMALL_SIZE = 64
+MESSAGE_SIZE = 2 ** 14
+UDP_WINDOW = 64
+UDP_FLOWS = 16
+UDP_DRAIN_TIMEOUT = 5
+
+MODES = ('nmp', 'sockv5', 'tproxy')
+TRANSPORTS = ('websocket', 'frame')
+LOOPS = ('asyncio', 'uvloop')
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def rss(pid='self'):
+    try:
+        with open(f'/proc/{pid}/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return None
+
+
+def cpu_seconds(pid):
+    # user + system time of another process
+    with open(f'/proc/{pid}/stat') as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def raise_nofile():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def install_loop(name):
+    if 'uvloop' == name:
+        import uvloop
+        uvloop.install()
+
+
+async def wait_port(port, host='127.0.0.1'):
+    for _ in range(100):
+        try:
+            _, w = await asyncio.open_connection(host, port)
+            w.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.05)
+    raise RuntimeError(f'port {port} not ready')
+
+
+async def echo_handler(r, w):
+    try:
+        while True:
+            data = await r.read(CHUNK_SIZE)
+            if not data:
+                break
+            w.write(data)
+            await w.drain()
+    except ConnectionError:
+        pass
+    finally:
+        w.close()
+
+
+# | 4 bytes | -> size bytes
+# |  size   |
+async def source_handler(r, w):
+    chunk = bytes(CHUNK_SIZE)
+    try:
+        size = struct.unpack('!I', await r.readexactly(4))[0]
+        while size > 0:
+            w.write(chunk[:size])
+            size -= len(chunk)
+            await w.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        w.close()
+
+
+# | 4 bytes |  ...  | -> 1 byte ack
+# |  size   | bytes |
+async def sink_handler(r, w):
+    try:
+        size = struct.unpack('!I', await r.readexactly(4))[0]
+        while size > 0:
+            data = await r.read(CHUNK_SIZE)
+            if not data:
+                break
+            size -= len(data)
+        w.write(b'k')
+        await w.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        w.close()
+
+
+def listener_hosts(count):
+    # all of 127/8 is loopback, every address has its own source port range
+    return [f'127.0.0.{i}' for i in range(1, max(count, 1) + 1)]
+
+
+def self_signed_cert(tmpdir, hosts=('127.0.0.1',)):
+    certfile = os.path.join(tmpdir, 'cert.pem')
+    keyfile = os.path.join(tmpdir, 'key.pem')
+    san = ','.join(f'IP:{host}' for host in hosts)
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                    '-subj', '/CN=127.0.0.1', '-addext', f'subjectAltName={san}',
+                    '-keyout', keyfile, '-out', certfile],
+                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return certfile, keyfile
+
+
+class DatagramEcho:
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UDP_RCVBUF)
+
+    def datagram_received(self, data, addr):
+        self.transport.sendto(data, addr)
+
+
+async def serve(args):
+    loop = asyncio.get_running_loop()
+    targets = {}
+    for name, handler in (('echo', echo_handler), ('source', source_handler), ('sink', sink_handler)):
+        server = await asyncio.start_server(handler, '127.0.0.1', 0, backlog=MAX_BACKLOG)
+        targets[name] = server.sockets[0].getsockname()[1]
+    # the memory run spreads upstream connects over one echo port per listener
+    targets['echoes'] = [targets['echo']]
+    for _ in range(args.listeners - 1):
+        server = await asyncio.start_server(echo_handler, '127.0.0.1', 0, backlog=MAX_BACKLOG)
+        targets['echoes'].append(server.sockets[0].getsockname()[1])
+    transport, _ = await loop.create_datagram_endpoint(DatagramEcho, local_addr=('127.0.0.1', 0))
+    targets['udp'] = transport.get_extra_info('sockname')[1]
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config = Config()
+        config.server = 'nmp'
+        config.port = free_port()
+        config.conf = os.path.join(tmpdir, 'token')
+        config.stream = args.stream
+        config.coalesce_delay = args.coalesce_delay
+        config.compression = args.compression
+        if 'frame' == args.transport:
+            config.frame_port = free_port()
+        hosts = listener_hosts(args.listeners)
+        if args.tls:
+            config.certfile, config.keyfile = self_signed_cert(tmpdir, hosts)
+            targets['cafile'] = config.certfile
+        tasks = []
+        for host in hosts:
+            config = copy.copy(config)
+            config.host = host
+            server = NmpServer(config)
+            tasks.append(asyncio.create_task(server.start_server()))
+            await wait_port(config.port, host)
+            if config.frame_port:
+                await wait_port(config.frame_port, host)
+        targets['nmp'] = config.frame_port or config.port
+        targets['token'] = server.token
+        print(json.dumps(targets), flush=True)
+        await asyncio.gather(*tasks)
+
+
+class BenchStreamHandler(StreamHandler):
+    def __init__(self, sock, pool, target, fast_open=False):
+        super().__init__(sock, pool, fast_open)
+        self.target = target
+
+    def get_dst_addr(self):
+        return self.target
+
+
+class BenchDatagramHandler(DatagramHandler):
+    def __init__(self, server):
+        super().__init__(server.tunnel)
+        self.server = server
+
+    def get_dst_addr(self, anc):
+        return self.server.target
+
+    def reply(self, data, from_addr, to_addr):
+        self.server.datagram_sock.sendto(data, to_addr)
+
+
+class BenchTransparentServer(TransparentServer):
+    # plain listeners with a fixed destination instead of TPROXY, so
+    # neither capabilities nor iptables rules are needed
+    def __init__(self, config, target):
+        self.target = target
+        super().__init__(config)
+
+    def new_datagram_socket(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UDP_RCVBUF)
+        sock.bind((self.config.host, self.config.port))
+        return sock
+
+    def new_datagram_handler(self):
+        return BenchDatagramHandler(self)
+
+    def new_stream_socket(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.config.host, self.config.port))
+        sock.listen(MAX_BACKLOG)
+        return sock
+
+    async def stream_handler(self, sock):
+        handler = BenchStreamHandler(sock, self.pool, self.target, self.config.fast_open)
+        try:
+            await handler.handle()
+        except Exception:
+            if not handler.sock.closed:
+                await handler.sock.close()
+
+    async def start_server(self):
+        self.pool.start()
+        self.tunnel.start()
+        await self.start_stream_server()
+        self.start_datagram_server()
+        await asyncio.Future()
+
+
+class BenchEnv:
+    def __init__(self, args, mode):
+        self.args = args
+        self.mode = mode
+        self.process = None
+        self.targets = None
+        self.pool = None
+        self.servers = []
+        self.tasks = []
+        self.ports = {}
+
+    def client_config(self, **kwargs):
+        config = Config()
+        config.host = '127.0.0.1'
+        if 'frame' == self.args.transport:
+            scheme = 'tls' if self.args.tls else 'tcp'
+        else:
+            scheme = 'wss' if self.args.tls else 'ws'
+        config.endpoint = ','.join(f'{scheme}://{host}:{self.targets["nmp"]}'
+                                   for host in listener_hosts(self.args.listeners))
+        config.cafile = self.targets.get('cafile')
+        config.tls13 = self.args.tls13
+        config.token = self.targets['token']
+        config.stream = self.args.stream
+        config.mux = self.args.mux
+        config.pool_size = self.args.pool_size
+        config.coalesce_delay = self.args.coalesce_delay
+        config.fast_open = self.args.fast_open
+        config.compression = self.args.compression
+        for k, v in kwargs.items():
+            setattr(config, k, v)
+        return config
+
+    async def start(self):
+        self.process = await asyncio.create_subprocess_exec(
+            sys.executable, '-m', 'nmp.bench', '--serve',
+            '--loop', self.args.loop,
+            '--stream', self.args.stream,
+            '--coalesce-delay', str(self.args.coalesce_delay),
+            '--compression', self.args.compression,
+            '--listeners', str(self.args.listeners),
+            '--transport', self.args.transport,
+            *(['--tls'] if self.args.tls else []),
+            stdout=subprocess.PIPE)
+        self.targets = json.loads(await self.process.stdout.readline())
+
+        self.pool = ConnectionPool(self.client_config())
+        self.pool.start()
+        if 'sockv5' == self.mode:
+            await self.start_local('sockv5', SockV5Server(self.client_config(port=free_port())))
+        elif 'tproxy' == self.mode:
+            for name in ('echo', 'source', 'sink', 'udp'):
+                config = self.client_config(port=free_port())
+                target = ('127.0.0.1', self.targets[name])
+                await self.start_local(name, BenchTransparentServer(config, target))
+        if self.pool.refill_task:
+            await self.pool.refill_task
+
+    async def start_local(self, name, server):
+        self.servers.append(server)
+        self.tasks.append(asyncio.create_task(server.start_server()))
+        await wait_port(server.config.port)
+        self.ports[name] = server.config.port
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        for server in self.servers:
+            await server.tunnel.close()
+            await server.pool.close()
+        await self.pool.close()
+        self.process.terminate()
+        await self.process.wait()
+
+    def server_rss(self):
+        return rss(self.process.pid)
+
+    async def open(self, name, index=0):
+        port = self.targets[name]
+        if 'nmp' == self.mode:
+            if 'echo' == name:
+                port = self.targets['echoes'][index % len(self.targets['echoes'])]
+            req = bytearray(struct.pack('!BH', NMP_TCP_PIPE_IP, port))
+            req.extend(b'127.0.0.1')
+            return await self.pool.open_stream(req)
+        if 'tproxy' == self.mode:
+            r, w = await asyncio.open_connection('127.0.0.1', self.ports[name])
+            return SocketStream(r, w)
+
+        r, w = await asyncio.open_connection('127.0.0.1', self.ports['sockv5'])
+        w.write(b'\x05\x01\x00')
+        await r.readexactly(2)
+        w.write(struct.pack('!BBBB4sH', 5, 1, 0, 1, socket.inet_aton('127.0.0.1'), port))
+        reply = await r.readexactly(10)
+        if reply[1] != 0:
+            w.close()
+            return None
+        return SocketStream(r, w)
+
+    async def open_udp(self, on_reply):
+        # (sockv5 control writer, transport to the relay)
+        loop = asyncio.get_running_loop()
+        if 'tproxy' == self.mode:
+            transport, _ = await loop.create_datagram_endpoint(
+                lambda: DatagramClient(on_reply), remote_addr=('127.0.0.1', self.ports['udp']))
+            return None, transport
+
+        r, w = await asyncio.open_connection('127.0.0.1', self.ports['sockv5'])
+        w.write(b'\x05\x01\x00')
+        await r.readexactly(2)
+        w.write(struct.pack('!BBBB4sH', 5, 3, 0, 1, socket.inet_aton('0.0.0.0'), 0))
+        reply = await r.readexactly(10)
+        if reply[1] != 0:
+            w.close()
+            return None
+        relay = (socket.inet_ntoa(reply[4:8]), struct.unpack('!H', reply[8:10])[0])
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda: DatagramClient(on_reply, UDP_IPV4_HEADER.size), remote_addr=relay)
+        return w, transport
+
+
+async def recv_exactly(sock, size):
+    received = 0
+    while received < size:
+        msg = await sock.recv()
+        if not len(msg):
+            raise ConnectionResetError(f'closed after {received} of {size} bytes')
+        received += len(msg)
+    return received
+
+
+async def bench_throughput(env):
+    size = env.args.size * 2 ** 20
+    pid = env.process.pid
+    results = []
+
+    sock = await env.open('source')
+    start, cpu, server_cpu = time.perf_counter(), time.process_time(), cpu_seconds(pid)
+    await sock.send(struct.pack('!I', size))
+    await recv_exactly(sock, size)
+    results.append((time.perf_counter() - start, time.process_time() - cpu,
+                    cpu_seconds(pid) - server_cpu, 'download'))
+    await sock.close()
+
+    sock = await env.open('sink')
+    chunk = bytes(CHUNK_SIZE)
+    start, cpu, server_cpu = time.perf_counter(), time.process_time(), cpu_seconds(pid)
+    await sock.send(struct.pack('!I', size))
+    for _ in range(size // len(chunk)):
+        await sock.send(chunk)
+    await recv_exactly(sock, 1)
+    results.append((time.perf_counter() - start, time.process_time() - cpu,
+                    cpu_seconds(pid) - server_cpu, 'upload'))
+    await sock.close()
+
+    return [{
+        'bench': 'throughput',
+        'direction': direction,
+        'metric': 'mbytes_per_sec',
+        'better': 'higher',
+        'value': round(size / elapsed / 2 ** 20, 2),
+        'bytes': size,
+        'client_cpu_seconds_per_gb': round(cpu / size * 2 ** 30, 2),
+        # the nmp server and the tcp targets share a process
+        'server_cpu_seconds_per_gb': round(server_cpu / size * 2 ** 30, 2),
+    } for elapsed, cpu, server_cpu, direction in results]
+
+
+async def bench_latency(env):
+    sock = await env.open('echo')
+    msg = bytes(SMALL_SIZE)
+    rtts = []
+    for _ in range(env.args.count):
+        start = time.perf_counter()
+        await sock.send(msg)
+        await recv_exactly(sock, len(msg))
+        rtts.append(time.perf_counter() - start)
+    await sock.close()
+    rtts.sort()
+    return [{
+        'bench': 'latency',
+        'metric': 'rtt_p50_us',
+        'better': 'lower',
+        'value': round(rtts[len(rtts) // 2] * 1e6, 1),
+        'rtt_p99_us': round(rtts[int(len(rtts) * 0.99)] * 1e6, 1),
+        'rtt_mean_us': round(sum(rtts) / len(rtts) * 1e6, 1),
+        'count': len(rtts),
+    }]
+
+
+def tls_handshakes(session):
+    return sum(child.value for (_, s), child in TLS_HANDSHAKES.children.items() if s == session)
+
+
+async def bench_connect(env):
+    count = env.args.count
+    sem = asyncio.Semaphore(env.args.concurrency)
+    failed = 0
+
+    async def connect_once():
+        nonlocal failed
+        async with sem:
+            sock = await env.open('echo')
+            if not sock:
+                failed += 1
+                return
+            await sock.send(b'x')
+            await sock.recv()
+            await sock.close()
+
+    handshakes = HANDSHAKE_SECONDS.labels()
+    seconds, handshaked = handshakes.sum, handshakes.count
+    resumed = tls_handshakes('resumed')
+    full = tls_handshakes('full')
+    start, cpu = time.perf_counter(), time.process_time()
+    await asyncio.gather(*[connect_once() for _ in range(count)])
+    elapsed, cpu = time.perf_counter() - start, time.process_time() - cpu
+    seconds, handshaked = handshakes.sum - seconds, handshakes.count - handshaked
+    resumed = tls_handshakes('resumed') - resumed
+    full = tls_handshakes('full') - full
+    return [{
+        'bench': 'connect',
+        'metric': 'connects_per_sec',
+        'better': 'higher',
+        'value': round(count / elapsed, 2),
+        'count': count,
+        'failed': failed,
+        'concurrency': env.args.concurrency,
+        'client_cpu_ms_per_connect': round(cpu / count * 1000, 3),
+        'handshakes': handshaked,
+        'handshake_mean_ms': round(seconds / handshaked * 1000, 3) if handshaked else None,
+        'tls_resumed': resumed,
+        'tls_full': full,
+    }]
+
+
+class DatagramClient(asyncio.DatagramProtocol):
+    def __init__(self, on_reply, header=0):
+        self.on_reply = on_reply
+        self.header = header
+
+    def datagram_received(self, data, addr):
+        self.on_reply(data[self.header:], addr, None)
+
+
+async def bench_udp(env):
+    # the nmp client has no udp, sockv5 relays through UDP ASSOCIATE and
+    # tproxy through its datagram socket with a fixed destination
+    if 'nmp' == env.mode:
+        return []
+    count = env.args.count * 10
+    dst = ('127.0.0.1', env.targets['udp'])
+    window = asyncio.Semaphore(env.args.udp_window)
+    done = asyncio.get_running_loop().create_future()
+    received = 0
+
+    def on_reply(data, from_addr, to_addr):
+        nonlocal received
+        received += 1
+        window.release()
+        if received == count and not done.done():
+            done.set_result(None)
+
+    msg = bytes(SMALL_SIZE)
+    if 'sockv5' == env.mode:
+        msg = UDP_IPV4_HEADER.pack(0, 0, 1, socket.inet_aton(dst[0]), dst[1]) + msg
+    flows = [await env.open_udp(on_reply) for _ in range(UDP_FLOWS)]
+    if not all(flows):
+        return [{'bench': 'udp', 'error': 'udp associate failed'}]
+    start = time.perf_counter()
+    for i in range(count):
+        await window.acquire()
+        flows[i % UDP_FLOWS][1].sendto(msg)
+    try:
+        await asyncio.wait_for(done, UDP_DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        pass
+    elapsed = time.perf_counter() - start
+    for control, transport in flows:
+        transport.close()
+        if control:
+            control.close()
+    return [{
+        'bench': 'udp',
+        'metric': 'packets_per_sec',
+        'better': 'higher',
+        'value': round(received / elapsed, 2),
+        'sent': count,
+        'received': received,
+        'window': env.args.udp_window,
+    }]
+
+
+async def bench_memory(env):
+    gc.collect()
+    client_before, server_before = rss(), env.server_rss()
+    socks = []
+    error = None
+    try:
+        for i in range(env.args.idle):
+            sock = await env.open('echo', i)
+            if not sock:
+                break
+            socks.append(sock)
+    except OSError as e:
+        error = str(e)
+    # one round trip so both ends are fully set up before measuring
+    for sock in socks:
+        await sock.send(b'x')
+    for sock in socks:
+        await sock.recv()
+    await asyncio.sleep(0.5)
+    gc.collect()
+    client_after, server_after = rss(), env.server_rss()
+    for sock in socks:
+        await sock.close()
+
+    if not socks or client_before is None:
+        return [{'bench': 'memory', 'error': error or 'rss is not available'}]
+    client = (client_after - client_before) / len(socks)
+    server = (server_after - server_before) / len(socks)
+    result = {
+        'bench': 'memory',
+        'metric': 'bytes_per_tunnel',
+        'better': 'lower',
+        'value': round(client + server),
+        'tunnels': len(socks),
+        'client_bytes_per_tunnel': round(client),
+        'server_bytes_per_tunnel': round(server),
+        'mbytes_per_10k_tunnels': round((client + server) * 10000 / 2 ** 20, 1),
+    }
+    if env.args.memory_budget:
+        result['budget'] = env.args.memory_budget
+        result['over_budget'] = result['value'] > env.args.memory_budget
+    if error:
+        result['error'] = error
+    return [result]
+
+
+async def bench_coalesce(env):
+    count = env.args.count * 100
+    msg = bytes(SMALL_SIZE)
+    sock = await env.open('echo')
+    frames = COALESCE_FRAMES.labels().value
+
+    start = time.perf_counter()
+    task = asyncio.create_task(recv_exactly(sock, count * len(msg)))
+    for _ in range(count):
+        await sock.send(msg)
+    await task
+    elapsed = time.perf_counter() - start
+    frames = COALESCE_FRAMES.labels().value - frames
+    await sock.close()
+    return [{
+        'bench': 'coalesce',
+        'metric': 'messages_per_sec',
+        'better': 'higher',
+        'value': round(count / elapsed, 2),
+        'messages': count,
+        'client_frames': frames,
+        'client_bytes_per_frame': round(count * len(msg) / frames, 2) if frames else None,
+    }]
+
+
+WORDS = ('the', 'tunnel', 'request', 'response', 'status', 'user', 'session', 'cache',
+         'error', 'value', 'stream', 'token', 'server', 'client', 'frame', 'window')
+
+
+def text_payload(size):
+    rng = random.Random(0)
+    lines = []
+    while sum(len(line) for line in lines) < size:
+        lines.append(json.dumps({'id': len(lines), 'name': rng.choice(WORDS),
+                                 'text': ' '.join(rng.choices(WORDS, k=12))}) + '\n')
+    return ''.join(lines).encode()[:size]
+
+
+def deflate_wire_bytes():
+    return (DEFLATE_BYTES.labels('compress', 'wire').value
+            + DEFLATE_BYTES.labels('compress', 'skipped').value)
+
+
+async def compression_run(config, kind, payload, size):
+    async def sink(wsock, path):
+        install_policy(wsock, config)
+        received = 0
+        async for msg in wsock:
+            received += len(msg)
+            if received >= size:
+                await wsock.send(b'k')
+
+    async with websockets.serve(sink, '127.0.0.1', 0, **compression_options(config)) as server:
+        port = server.sockets[0].getsockname()[1]
+        wsock = await websockets.connect(f'ws://127.0.0.1:{port}', **compression_options(config))
+        install_policy(wsock, config)
+        wire = deflate_wire_bytes()
+        start, cpu = time.perf_counter(), time.process_time()
+        sent = 0
+        while sent < size:
+            offset = sent % len(payload)
+            msg = payload[offset:offset + MESSAGE_SIZE]
+            await wsock.send(msg)
+            sent += len(msg)
+        await wsock.recv()
+        elapsed, cpu = time.perf_counter() - start, time.process_time() - cpu
+        wire = deflate_wire_bytes() - wire
+        await wsock.close()
+    return {
+        'bench': 'compression',
+        'compression': config.compression,
+        'payload': kind,
+        'metric': 'mbytes_per_sec',
+        'better': 'higher',
+        'value': round(sent / elapsed / 2 ** 20, 2),
+        'bytes': sent,
+        # both ends run in this process
+        'cpu_seconds_per_gb': round(cpu / sent * 2 ** 30, 2),
+        'wire_ratio': round(wire / sent, 3) if wire else 1,
+    }
+
+
+async def bench_compression(args):
+    size = args.size * 2 ** 20
+    payloads = {'random': os.urandom(2 ** 20), 'text': text_payload(2 ** 20)}
+    results = []
+    for mode in COMPRESSION_MODES:
+        config = Config()
+        config.compression = mode
+        for kind, payload in payloads.items():
+            results.append(await compression_run(config, kind, payload, size))
+    return results
+
+
+class MemoryReader:
+    def __init__(self, count, chunk):
+        self.count = count
+        self.chunk = chunk
+
+    async def read(self, n):
+        if self.count <= 0:
+            return b''
+        self.count -= 1
+        return self.chunk
+
+
+class MemoryWriter:
+    def write(self, data):
+        pass
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        pass
+
+    async def wait_closed(self):
+        pass
+
+    def get_extra_info(self, name):
+        return None
+
+
+async def bench_overhead(args):
+    count = args.count * 100
+    start = time.perf_counter()
+    for _ in range(count):
+        Pipe(SocketStream(None, MemoryWriter()), SocketStream(None, MemoryWriter()))
+    setup = time.perf_counter() - start
+
+    r = SocketStream(MemoryReader(count, bytes(SMALL_SIZE)), MemoryWriter())
+    w = SocketStream(None, MemoryWriter())
+    pipe = Pipe(r, w)
+    pipe.pipeing = True
+    start = time.perf_counter()
+    await pipe.recv_and_send(r, w, 'up')
+    relay = time.perf_counter() - start
+
+    # limits too high to be hit, the cost of the token buckets alone
+    config = Config()
+    config.rate_limit = config.client_rate_limit = str(2 ** 30)
+    r = SocketStream(MemoryReader(count, bytes(SMALL_SIZE)), MemoryWriter())
+    pipe = Pipe(r, w, flow=Shaper(config).flow('127.0.0.1'))
+    pipe.pipeing = True
+    start = time.perf_counter()
+    await pipe.recv_and_send(r, w, 'up')
+    shaped = time.perf_counter() - start
+    return [{
+        'bench': 'overhead',
+        'metric': 'relay_us_per_chunk',
+        'better': 'lower',
+        'value': round(relay / count * 1e6, 3),
+        'count': count,
+        'setup_us_per_connection': round(setup / count * 1e6, 3),
+        'shaped_relay_us_per_chunk': round(shaped / count * 1e6, 3),
+    }]
+
+
+BENCHES = {
+    'throughput': bench_throughput,
+    'latency': bench_latency,
+    'connect': bench_connect,
+    'udp': bench_udp,
+    'memory': bench_memory,
+    'coalesce': bench_coalesce,
+}
+# no servers involved, run once per loop
+LOCAL_BENCHES = {
+    'overhead': bench_overhead,
+    'compression': bench_compression,
+}
+DEFAULT_BENCHES = ('throughput', 'latency', 'connect', 'udp', 'memory')
+
+
+async def run(args):
+    raise_nofile()
+    names = args.bench.split(',')
+    results = []
+    for name in names:
+        if name in LOCAL_BENCHES:
+            for result in await LOCAL_BENCHES[name](args):
+                results.append(dict(result, loop=args.loop, mode=None))
+
+    for mode in args.modes.split(','):
+        env = BenchEnv(args, mode)
+        await env.start()
+        try:
+            for name in names:
+                if name in BENCHES:
+                    for result in await BENCHES[name](env):
+                        results.append(dict(result, loop=args.loop, mode=mode, transport=args.transport))
+        finally:
+            await env.stop()
+    return results
+
+
+def spawn(argv, loop):
+    # one process per loop, a policy can't be swapped once a loop has run
+    try:
+        __import__(loop)
+    except ImportError:
+        return [{'loop': loop, 'error': f'{loop} is not installed'}]
+    proc = subprocess.run([sys.executable, '-m', 'nmp.bench', *argv, '--loop', loop],
+                          stdout=subprocess.PIPE)
+    if proc.returncode != 0:
+        return [{'loop': loop, 'error': f'exit code {proc.returncode}'}]
+    return json.loads(proc.stdout)
+
+
+# fields telling apart results of one bench
+RESULT_VARIANTS = ('direction', 'compression', 'payload', 'transport')
+
+
+def result_key(result):
+    return (result.get('loop'), result.get('mode'), result.get('bench'), result.get('metric'),
+            *[result.get(k) for k in RESULT_VARIANTS])
+
+
+def compare(results, baseline, tolerance):
+    base = {result_key(r): r for r in baseline if 'value' in r}
+    regressions = []
+    for result in results:
+        old = base.get(result_key(result))
+        if not old or 'value' not in result or not old['value']:
+            continue
+        change = (result['value'] - old['value']) / old['value'] * 100
+        result['baseline'] = old['value']
+        result['change_pct'] = round(change, 2)
+        if (-change if 'higher' == result['better'] else change) > tolerance:
+            regressions.append(result_key(result))
+    return regressions
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    parser = argparse.ArgumentParser(prog='nmp bench')
+    parser.add_argument('--bench', dest='bench', default=','.join(DEFAULT_BENCHES),
+                        help=f'benchmarks: {",".join(list(BENCHES) + list(LOCAL_BENCHES))} '
+                             f'(default: {",".join(DEFAULT_BENCHES)})')
+    parser.add_argument('--modes', dest='modes', default=','.join(MODES),
+                        help=f'client modes (default: {",".join(MODES)})')
+    parser.add_argument('--loops', dest='loops', default=','.join(LOOPS),
+                        help=f'event loops (default: {",".join(LOOPS)})')
+    parser.add_argument('--uvloop', dest='uvloop', help='uvloop only, same as --loops uvloop')
+    parser.add_argument('--count', dest='count', type=int, default=500,
+                        help='connects and round trips per run (default: 500)')
+    parser.add_argument('--concurrency', dest='concurrency', type=int, default=32,
+                        help='concurrent connects (default: 32)')
+    parser.add_argument('--size', dest='size', type=int, default=64,
+                        help='megabytes per throughput run (default: 64)')
+    parser.add_argument('--udp-window', dest='udp_window', type=int, default=UDP_WINDOW,
+                        help=f'udp datagrams in flight (default: {UDP_WINDOW})')
+    parser.add_argument('--idle', dest='idle', type=int, default=10000,
+                        help='idle tunnels held by the memory run (default: 10000)')
+    parser.add_argument('--memory-budget', dest='memory_budget', type=int, default=0,
+                        help='fail when an idle tunnel costs more bytes (default: 0, off)')
+    parser.add_argument('--listeners', dest='listeners', type=int, default=1,
+                        help='nmp servers on 127.0.0.1..127.0.0.N, about 28k tunnels each (default: 1)')
+    parser.add_argument('--stream', dest='stream', default='default',
+                        help=f'stream implementation {"/".join(STREAM_TYPES)} (default: default)')
+    parser.add_argument('--mux', dest='mux', type=int, default=0,
+                        help='client multiplexes over N websockets (default: 0)')
+    parser.add_argument('--pool-size', dest='pool_size', type=int, default=0,
+                        help='client pre-warmed websockets (default: 0)')
+    parser.add_argument('--coalesce-delay', dest='coalesce_delay', type=float, default=0,
+                        help='coalescing latency budget in ms (default: 0)')
+    parser.add_argument('--compression', dest='compression', default='adaptive',
+                        help=f'permessage-deflate {"/".join(COMPRESSION_MODES)} (default: adaptive)')
+    parser.add_argument('--tls', dest='tls', action='store_true',
+                        help='wss or tls frames with a self-signed certificate, needs the openssl cli')
+    parser.add_argument('--tls13', dest='tls13', action='store_true', help='allow tls 1.3')
+    parser.add_argument('--transport', dest='transport', default='websocket',
+                        help=f'client to nmp server transport {"/".join(TRANSPORTS)} (default: websocket)')
+    parser.add_argument('--fast-open', dest='fast_open', action='store_true',
+                        help='sockv5/tproxy clients reply before the tunnel is connected')
+    parser.add_argument('--output', dest='output', help='also write the report to a file')
+    parser.add_argument('--baseline', dest='baseline', help='report to compare with')
+    parser.add_argument('--tolerance', dest='tolerance', type=float, default=10,
+                        help='allowed regression against --baseline in percent (default: 10)')
+    parser.add_argument('--loop', dest='loop', help=argparse.SUPPRESS)
+    parser.add_argument('--serve', dest='serve', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.loop:
+        install_loop(args.loop)
+        if args.serve:
+            raise_nofile()
+            asyncio.run(serve(args))
+        else:
+            print(json.dumps(asyncio.run(run(args))))
+        return
+
+    if args.uvloop and 'yes' == args.uvloop:
+        args.loops = 'uvloop'
+    results = []
+    for loop in args.loops.split(','):
+        results.extend(spawn(argv, loop))
+    report = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'args': vars(args),
+        },
+        'results': results,
+    }
+    if args.baseline:
+        with open(args.baseline) as f:
+            report['regressions'] = compare(results, json.load(f)['results'], args.tolerance)
+    over_budget = [result_key(r) for r in results if r.get('over_budget')]
+    if over_budget:
+        report['over_budget'] = over_budget
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    print(output)
+    if report.get('regressions') or report.get('over_budget'):
+        sys.exit(1)
+
+
+if '__main__' == __name__:
+    main()
@@ -0,0 +1,126 @@
+#!/bin/env python3
+
+import time
+import zlib
+from websockets.extensions.permessage_deflate import PerMessageDeflate
+from websockets.frames import CTRL_OPCODES, OP_CONT
+from nmp.log import get_logger
+from nmp.metrics import DEFLATE_BYTES, DEFLATE_DECISIONS, DEFLATE_SECONDS
+
+logger = get_logger(__name__)
+
+COMPRESSION_MODES = ('off', 'on', 'adaptive')
+# tls, ssh and friends don't compress
+ENCRYPTED_PORTS = frozenset((22, 443, 465, 563, 636, 853, 989, 990, 992, 993, 995, 5223, 8443))
+DEFLATE_SAMPLE_SIZE = 2 ** 16
+# smaller messages barely shrink, sending them plain also keeps idle
+# tunnels from allocating zlib state
+DEFLATE_MIN_SIZE = 2 ** 8
+# compressed / raw above this isn't worth the cpu
+DEFLATE_MAX_RATIO = 0.9
+# bytes sent plain before sampling again
+DEFLATE_SKIP_SIZE = 2 ** 22
+
+
+def compression_options(config):
+    # 'off' doesn't offer or accept permessage-deflate at all
+    return {'compression': None} if config.compression == 'off' else {}
+
+
+class DeflatePolicy:
+    # wraps the negotiated PerMessageDeflate, whole messages may be sent
+    # without compression, the peer sees a clear RSV1 bit and passes them
+    def __init__(self, extension, adaptive):
+        self.extension = extension
+        self.name = extension.name
+        # zlib keeps ~40KB per direction and most tunnels never compress,
+        # create them on first use, a new context starts a new stream
+        if not extension.local_no_context_takeover:
+            extension.encoder = None
+        if not extension.remote_no_context_takeover:
+            extension.decoder = None
+        self.adaptive = adaptive
+        self.compress = True
+        self.permanent = False
+        # current sample window or plain run
+        self.raw = 0
+        self.wire = 0
+        self.skipped = 0
+
+    def on_port(self, port):
+        if self.adaptive and port in ENCRYPTED_PORTS:
+            self.compress = False
+            self.permanent = True
+            DEFLATE_DECISIONS.labels('port').inc()
+
+    def decode(self, frame, *, max_size=None):
+        if frame.opcode in CTRL_OPCODES or not (frame.rsv1 or self.extension.decode_cont_data):
+            return self.extension.decode(frame, max_size=max_size)
+        if frame.rsv1 and not self.extension.remote_no_context_takeover and not self.extension.decoder:
+            self.extension.decoder = zlib.decompressobj(wbits=-self.extension.remote_max_window_bits)
+        start = time.perf_counter()
+        decoded = self.extension.decode(frame, max_size=max_size)
+        DEFLATE_SECONDS.labels('decompress').inc(time.perf_counter() - start)
+        DEFLATE_BYTES.labels('decompress', 'wire').inc(len(frame.data))
+        DEFLATE_BYTES.labels('decompress', 'raw').inc(len(decoded.data))
+        return decoded
+
+    def encode(self, frame):
+        if frame.opcode in CTRL_OPCODES:
+            return frame
+        if frame.opcode is not OP_CONT:
+            # decisions only change between messages
+            self.decide()
+        if not self.compress or self.too_small(frame):
+            self.skipped += len(frame.data)
+            DEFLATE_BYTES.labels('compress', 'skipped').inc(len(frame.data))
+            return frame
+
+        extension = self.extension
+        if not extension.local_no_context_takeover and not extension.encoder:
+            extension.encoder = zlib.compressobj(wbits=-extension.local_max_window_bits,
+                                                 **extension.compress_settings)
+        start = time.perf_counter()
+        encoded = extension.encode(frame)
+        DEFLATE_SECONDS.labels('compress').inc(time.perf_counter() - start)
+        DEFLATE_BYTES.labels('compress', 'raw').inc(len(frame.data))
+        DEFLATE_BYTES.labels('compress', 'wire').inc(len(encoded.data))
+        self.raw += len(frame.data)
+        self.wire += len(encoded.data)
+        return encoded
+
+    def too_small(self, frame):
+        # single frame messages only, all frames of a message are sent alike
+        return (self.adaptive and frame.fin and frame.opcode is not OP_CONT
+                and len(frame.data) < DEFLATE_MIN_SIZE)
+
+    def decide(self):
+        if not self.adaptive or self.permanent:
+            return
+        if self.compress and self.raw >= DEFLATE_SAMPLE_SIZE:
+            ratio = self.wire / self.raw
+            self.compress = ratio <= DEFLATE_MAX_RATIO
+            DEFLATE_DECISIONS.labels('compress' if self.compress else 'skip').inc()
+            logger.debug('deflate ratio %.2f, compress %s', ratio, self.compress)
+            self.raw = self.wire = 0
+        elif not self.compress and self.skipped >= DEFLATE_SKIP_SIZE:
+            # traffic may change, mux sessions carry many streams
+            self.compress = True
+            self.skipped = 0
+
+
+def install_policy(wsock, config):
+    if config.compression == 'off':
+        return None
+    for i, extension in enumerate(wsock.extensions):
+        if isinstance(extension, PerMessageDeflate):
+            policy = DeflatePolicy(extension, config.compression == 'adaptive')
+            wsock.extensions[i] = policy
+            return policy
+    return None
+
+
+def set_port(wsock, port):
+    for extension in wsock.extensions:
+        if isinstance(extension, DeflatePolicy):
+            extension.on_port(port)
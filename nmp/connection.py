@@ -1,51 +1,307 @@
 #!/bin/env python3
 
+import asyncio
 import secrets
 import ssl
 import struct
+import time
+import weakref
 import websockets
 from collections import deque
 from random import randint
+from nmp import framing
+from nmp.balancer import Balancer
+from nmp.compression import compression_options, install_policy, set_port
 from nmp.log import get_logger
-from nmp.proto import NMP_UDP_PIPE_IP
+from nmp.metrics import CONNECTS, HANDSHAKE_SECONDS, POOL_CONNECTIONS, POOL_WAIT_SECONDS, TLS_HANDSHAKES
+from nmp.mux import MuxClient
+from nmp.pipe import FAST_OPEN_HEADER, WEBSOCKET_MAX_QUEUE, coalesce
+from nmp.proto import NMP_CONNECT_OK, NMP_CONNECT_OVERLOADED, NMP_TCP_PIPE_FAST
+
+logger = get_logger(__name__)
 
 MAX_MSG_BUF_SIZE = 2 ** 16
-MAX_IDLE_CONNECTION = 2 ** 10
+POOL_MAX_AGE = 120
+POOL_CHECK_INTERVAL = 10
+POOL_PING_TIMEOUT = 5
+POOL_REFILL_BATCH = 8
+POOL_RETRY_DELAY = 1
+
+
+class ResumingContext(ssl.SSLContext):
+    # asyncio never passes a session to wrap_bio, offer the last one
+    # seen for the same server name
+    def __init__(self, protocol):
+        super().__init__()
+        self.sessions = {}
+
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):
+        session = session or self.sessions.get(server_hostname)
+        return super().wrap_bio(incoming, outgoing, server_side, server_hostname, session)
+
+    def save_session(self, server_hostname, ssl_object):
+        if ssl_object.session:
+            self.sessions[server_hostname] = ssl_object.session
+
+
+def new_ssl_context(config):
+    context = ResumingContext(ssl.PROTOCOL_TLS_CLIENT)
+    if config.cafile:
+        context.load_verify_locations(config.cafile)
+    else:
+        context.load_default_certs()
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    if not config.tls13:
+        context.maximum_version = ssl.TLSVersion.TLSv1_2
+    return context
+
+
+class FastOpenStream:
+    # the connect reply is read by the first recv() instead of before
+    # the stream is handed out
+    __slots__ = ('wsock', 'pool', 'replied')
+
+    def __init__(self, wsock, pool):
+        self.wsock = wsock
+        self.pool = pool
+        self.replied = False
+
+    async def send(self, msg):
+        await self.wsock.send(msg)
+
+    async def recv(self):
+        if not self.replied:
+            self.replied = True
+            reply = await self.wsock.recv()
+            code = struct.unpack('!B', reply[:1])[0]
+            CONNECTS.labels('client', code).inc()
+            self.pool.replied(self.wsock, code)
+            if code != NMP_CONNECT_OK:
+                logger.warning('connect refused, error code %s', code)
+                await self.wsock.close()
+                return b''
+        return await self.wsock.recv()
+
+    async def close(self):
+        await self.wsock.close()
 
 
 class ConnectionPool:
-    def __init__(self, endpoint, token) -> None:
-        self.logger = get_logger(__name__)
-        self.endpoint = endpoint
-        self.token = token
-        self.queue = deque(maxlen=MAX_IDLE_CONNECTION)
-
-    async def open_connection(self):
-        if len(self.queue) > 0:
-            return self.queue.popleft()
+    def __init__(self, config) -> None:
+        self.config = config
+        self.balancer = Balancer(config.endpoint, config.balance)
+        self.token = config.token
+        # built once, loading the ca store costs tens of ms
+        self.ssl_context = None
+        self.mux = MuxClient(self, config.mux) if config.mux > 0 else None
+        # pre-warmed websockets, authenticated but not yet typed
+        self.pool_size = config.pool_size
+        self.idle = deque()
+        self.refill_task = None
+        self.check_task = None
+        self.hits = POOL_CONNECTIONS.labels('hit')
+        self.misses = POOL_CONNECTIONS.labels('miss')
+        self.evicted = POOL_CONNECTIONS.labels('evict')
+        # websocket -> Endpoint it was opened to
+        self.sources = weakref.WeakKeyDictionary()
+
+    def start(self):
+        if self.pool_size > 0 and not self.check_task:
+            self.check_task = asyncio.create_task(self.health_check())
+            self.maybe_refill()
+
+    def stats(self):
+        return {'idle': len(self.idle), 'hits': self.hits.value,
+                'misses': self.misses.value, 'evicted': self.evicted.value}
+
+    def maybe_refill(self):
+        if len(self.idle) >= self.pool_size:
+            return
+        if self.refill_task and not self.refill_task.done():
+            return
+        self.refill_task = asyncio.create_task(self.refill())
+
+    async def refill(self):
+        while len(self.idle) < self.pool_size:
+            need = min(self.pool_size - len(self.idle), POOL_REFILL_BATCH)
+            wsocks = await asyncio.gather(*[self.handshake() for _ in range(need)])
+            for wsock in wsocks:
+                if wsock:
+                    self.idle.append((wsock, time.monotonic()))
+            if not all(wsocks):
+                await asyncio.sleep(POOL_RETRY_DELAY)
+        logger.debug('pool refilled: %s', self.stats())
+
+    async def evict(self, entry):
+        try:
+            self.idle.remove(entry)
+        except ValueError:
+            return
+        self.evicted.inc()
+        await entry[0].close()
+
+    async def ping(self, entry):
+        wsock, created = entry
+        if not wsock.open or time.monotonic() - created > POOL_MAX_AGE:
+            await self.evict(entry)
+            return
+        try:
+            pong = await wsock.ping()
+            await asyncio.wait_for(pong, POOL_PING_TIMEOUT)
+        except Exception as e:
+            logger.debug('idle websocket ping failed: %s', e)
+            await self.evict(entry)
+
+    async def health_check(self):
+        while True:
+            await asyncio.sleep(POOL_CHECK_INTERVAL)
+            await asyncio.gather(*[self.ping(entry) for entry in list(self.idle)])
+            self.maybe_refill()
+
+    async def close(self):
+        for task in (self.check_task, self.refill_task):
+            if task:
+                task.cancel()
+        if self.mux:
+            await self.mux.close()
+        while len(self.idle) > 0:
+            await self.idle.popleft()[0].close()
+
+    def replied(self, wsock, code):
+        endpoint = self.sources.get(wsock)
+        if not endpoint:
+            return
+        if NMP_CONNECT_OVERLOADED == code:
+            endpoint.overloaded()
+        elif NMP_CONNECT_OK == code:
+            endpoint.accepted()
+
+    def backing_off(self):
+        if self.balancer.backing_off():
+            logger.debug('every endpoint is overloaded, fail fast')
+            return True
+        return False
+
+    async def open_stream(self, req):
+        if self.backing_off():
+            return None
+        if self.mux:
+            stream = await self.mux.open_stream(req)
+            return coalesce(stream, self.config) if stream else None
+
         wsock = await self.new_connection()
-        await wsock.send(struct.pack('!B', NMP_UDP_PIPE_IP))
+        if not wsock:
+            return None
+
+        set_port(wsock, struct.unpack('!H', req[1:3])[0])
+        await wsock.send(req)
+        reply = await wsock.recv()
+        code = struct.unpack('!B', reply[:1])[0]
+        CONNECTS.labels('client', code).inc()
+        self.replied(wsock, code)
+        if code != NMP_CONNECT_OK:
+            logger.warning('connect refused, error code %s', code)
+            await wsock.close()
+            return None
+
+        return coalesce(wsock, self.config)
+
+    async def open_fast_stream(self, host, port, payload):
+        if self.backing_off():
+            return None
+        req = bytearray(struct.pack('!B', NMP_TCP_PIPE_FAST))
+        req.extend(FAST_OPEN_HEADER.pack(port, len(host)))
+        req.extend(host)
+        req.extend(payload)
+        if self.mux:
+            stream = await self.mux.open_stream(req, wait=False)
+            return coalesce(stream, self.config) if stream else None
+
+        wsock = await self.new_connection()
+        if not wsock:
+            return None
+        set_port(wsock, port)
+        await wsock.send(req)
+        return coalesce(FastOpenStream(wsock, self), self.config)
+
+    async def new_connection(self):
+        start = time.perf_counter()
+        wsock = await self.acquire()
+        POOL_WAIT_SECONDS.labels().observe(time.perf_counter() - start)
         return wsock
 
-    async def close_connection(self, connection):
-        if len(self.queue) >= MAX_IDLE_CONNECTION:
-            await connection.close()
+    async def acquire(self):
+        while len(self.idle) > 0:
+            wsock, created = self.idle.popleft()
+            if wsock.open and time.monotonic() - created <= POOL_MAX_AGE:
+                self.hits.inc()
+                self.maybe_refill()
+                return wsock
+            self.evicted.inc()
+            await wsock.close()
+
+        if self.pool_size > 0:
+            self.misses.inc()
+            self.maybe_refill()
+        return await self.handshake()
+
+    async def handshake(self):
+        start = time.perf_counter()
+        wsock = await self.connect()
+        if wsock:
+            HANDSHAKE_SECONDS.labels().observe(time.perf_counter() - start)
+        return wsock
+
+    async def connect(self):
+        # fail over to the other endpoints before giving up
+        tried = []
+        while True:
+            endpoint = self.balancer.pick(tried)
+            if not endpoint:
+                return None
+            tried.append(endpoint)
+            wsock = await self.connect_endpoint(endpoint)
+            if wsock:
+                return wsock
+
+    def tls_connected(self, endpoint, wsock):
+        ssl_object = wsock.transport.get_extra_info('ssl_object')
+        TLS_HANDSHAKES.labels(endpoint.scheme, 'resumed' if ssl_object.session_reused else 'full').inc()
+        if 'wss' == endpoint.scheme:
+            self.ssl_context.save_session(endpoint.hostname, ssl_object)
             return
-        self.queue.append(connection)
+        # tls 1.3 tickets come after the handshake and nothing is read yet,
+        # the websocket handshake waited for the http reply instead
+        wsock.first_frame.add_done_callback(
+            lambda _: self.ssl_context.save_session(endpoint.hostname, ssl_object))
 
-    async def new_connection(self):
+    async def connect_endpoint(self, endpoint):
         try:
+            start = time.perf_counter()
             dummy = secrets.token_hex(randint(1, 16))
-            context = ssl.create_default_context()
-            context.options |= ssl.OP_NO_TLSv1
-            context.options |= ssl.OP_NO_TLSv1_1
-            context.options |= ssl.OP_NO_TLSv1_3
-            uri = f'{self.endpoint}/{self.token}/{dummy}'
-            if self.endpoint.startswith('wss://'):
-                return await websockets.connect(uri, ssl=context,
-                                                server_hostname=self.endpoint.split('/')[2])
+            path = f'/{self.token}/{dummy}'
+            if endpoint.scheme in ('wss', 'tls') and not self.ssl_context:
+                self.ssl_context = new_ssl_context(self.config)
+            if 'tls' == endpoint.scheme:
+                wsock = await framing.connect(endpoint.url, path, ssl=self.ssl_context,
+                                              server_hostname=endpoint.hostname)
+            elif 'tcp' == endpoint.scheme:
+                wsock = await framing.connect(endpoint.url, path)
             else:
-                return await websockets.connect(uri)
+                options = compression_options(self.config)
+                options['max_queue'] = WEBSOCKET_MAX_QUEUE
+                if 'wss' == endpoint.scheme:
+                    options['ssl'] = self.ssl_context
+                    options['server_hostname'] = endpoint.hostname
+                wsock = await websockets.connect(endpoint.url + path, **options)
+            if endpoint.scheme in ('wss', 'tls'):
+                self.tls_connected(endpoint, wsock)
+            endpoint.succeeded(time.perf_counter() - start)
+            endpoint.opened(wsock)
+            self.sources[wsock] = endpoint
+            install_policy(wsock, self.config)
+            return wsock
         except Exception as e:
-            self.logger.exception(e)
+            logger.error('connect to %s failed: %s', endpoint.url, e)
+            endpoint.failed()
             return None
@@ -0,0 +1,237 @@
+#!/bin/env python3
+
+import asyncio
+import socket
+import struct
+import time
+from nmp.log import get_logger
+from nmp.metrics import CONNECTS, UDP_RTT_SECONDS, UDP_TIMEOUTS
+from nmp.pipe import MAX_UDP_BATCH, PIPE_EXCEPTION, UDP_FLOW_HEADER, UDP_IDLE_TIMEOUT, pack_batch, unpack_batch
+from nmp.proto import NMP_CONNECT_OK, NMP_UDP_BATCH
+
+logger = get_logger(__name__)
+
+MAX_UDP_TUNNEL = 4
+UDP_REPLY_TIMEOUT = 5
+UDP_CHECK_INTERVAL = 1
+# datagrams queued per websocket or per flow waiting for one, more are dropped
+MAX_UDP_PENDING = 2 ** 10
+
+
+class DatagramFlow:
+    __slots__ = ('flow_id', 'src', 'dst', 'sender', 'callback', 'active', 'pending', 'backlog')
+
+    def __init__(self, flow_id, src, dst, callback):
+        self.flow_id = flow_id
+        self.src = src
+        self.dst = dst
+        self.sender = None
+        self.callback = callback
+        self.active = time.monotonic()
+        # send time of the oldest unanswered datagram
+        self.pending = None
+        # datagrams sent before the flow got a websocket
+        self.backlog = []
+
+
+class DatagramSender:
+    # one writer per websocket, datagrams queued while a frame is being
+    # sent go out together in the next one
+    __slots__ = ('wsock', 'queue', 'waiter', 'task')
+
+    def __init__(self, wsock):
+        self.wsock = wsock
+        self.queue = []
+        self.waiter = None
+        self.task = asyncio.create_task(self.run())
+
+    def put(self, msg):
+        if len(self.queue) >= MAX_UDP_PENDING:
+            logger.debug('udp queue full, drop datagram')
+            return False
+        self.queue.append(msg)
+        if self.waiter and not self.waiter.done():
+            self.waiter.set_result(None)
+        return True
+
+    def take(self):
+        size = 0
+        for i, msg in enumerate(self.queue):
+            size += len(msg)
+            if size > MAX_UDP_BATCH and i > 0:
+                batch, self.queue = self.queue[:i], self.queue[i:]
+                return batch
+        batch, self.queue = self.queue, []
+        return batch
+
+    async def run(self):
+        try:
+            while True:
+                if not self.queue:
+                    self.waiter = asyncio.get_running_loop().create_future()
+                    await self.waiter
+                await self.wsock.send(pack_batch(self.take()))
+        except PIPE_EXCEPTION as e:
+            logger.debug(e)
+            self.queue = []
+
+
+class DatagramTunnel:
+    def __init__(self, pool, size=MAX_UDP_TUNNEL):
+        self.pool = pool
+        self.size = size
+        self.senders = []
+        self.lock = asyncio.Lock()
+        self.rr = 0
+        self.next_id = 1
+        # flow id -> DatagramFlow, (src, dst) -> flow id
+        self.flows = {}
+        self.flow_ids = {}
+        self.check_task = None
+
+    def start(self):
+        if not self.check_task:
+            self.check_task = asyncio.create_task(self.expire())
+
+    async def close(self):
+        if self.check_task:
+            self.check_task.cancel()
+        for sender in self.senders:
+            sender.task.cancel()
+            await sender.wsock.close()
+        self.senders = []
+
+    async def new_sender(self):
+        if self.pool.backing_off():
+            return None
+        wsock = await self.pool.new_connection()
+        if not wsock:
+            return None
+        await wsock.send(struct.pack('!B', NMP_UDP_BATCH))
+        sender = DatagramSender(wsock)
+        self.senders.append(sender)
+        asyncio.create_task(self.recv_replies(wsock))
+        return sender
+
+    def pick_sender(self):
+        # round robin once every websocket is open, None while more are needed
+        self.senders = [s for s in self.senders if s.wsock.open]
+        if len(self.senders) < self.size:
+            return None
+        self.rr = (self.rr + 1) % len(self.senders)
+        return self.senders[self.rr]
+
+    async def get_sender(self):
+        async with self.lock:
+            sender = self.pick_sender()
+            if sender:
+                return sender
+            return await self.new_sender()
+
+    async def open_flow(self, flow):
+        sender = await self.get_sender()
+        if self.flows.get(flow.flow_id) is not flow:
+            return
+        if not sender:
+            self.remove_flow(flow)
+            return
+        flow.sender = sender
+        for msg in flow.backlog:
+            sender.put(msg)
+        flow.backlog = None
+
+    def new_flow(self, src, dst, callback):
+        flow_id = self.next_id
+        self.next_id = self.next_id % 0xffffffff + 1
+        flow = DatagramFlow(flow_id, src, dst, callback)
+        self.flows[flow_id] = flow
+        self.flow_ids[(src, dst)] = flow_id
+        flow.sender = self.pick_sender()
+        if not flow.sender:
+            # one task per new flow while websockets are being opened
+            asyncio.create_task(self.open_flow(flow))
+        return flow
+
+    def remove_flow(self, flow):
+        self.flows.pop(flow.flow_id, None)
+        self.flow_ids.pop((flow.src, flow.dst), None)
+
+    def remove_flows(self, src):
+        for flow in list(self.flows.values()):
+            if flow.src == src:
+                self.remove_flow(flow)
+
+    def send(self, src, dst, data, callback):
+        # queue a datagram, False when it was dropped
+        flow_id = self.flow_ids.get((src, dst))
+        flow = self.flows[flow_id] if flow_id else self.new_flow(src, dst, callback)
+        msg = bytearray(UDP_FLOW_HEADER.pack(flow.flow_id, NMP_CONNECT_OK,
+                                             socket.inet_aton(dst[0]), dst[1]))
+        msg.extend(data)
+        flow.active = time.monotonic()
+        if flow.pending is None:
+            flow.pending = flow.active
+        if flow.sender:
+            return flow.sender.put(msg)
+        if len(flow.backlog) >= MAX_UDP_PENDING:
+            return False
+        flow.backlog.append(msg)
+        return True
+
+    def dispatch(self, msg):
+        flow_id, code, ip, port = UDP_FLOW_HEADER.unpack_from(msg)
+        flow = self.flows.get(flow_id)
+        if not flow:
+            logger.debug('drop reply for unknown flow %s', flow_id)
+            return
+        flow.active = time.monotonic()
+        if flow.pending is not None:
+            UDP_RTT_SECONDS.labels().observe(flow.active - flow.pending)
+            flow.pending = None
+        addr = (socket.inet_ntoa(ip), port)
+        if code != NMP_CONNECT_OK:
+            logger.warning('forward message failed, addr=%s, error=%s', addr, code)
+            self.remove_flow(flow)
+            return
+        flow.callback(msg[UDP_FLOW_HEADER.size:], addr, flow.src)
+
+    async def recv_replies(self, wsock):
+        try:
+            while True:
+                frame = await wsock.recv()
+                if not isinstance(frame, bytes):
+                    logger.warning('invalid udp batch frame: %s', frame)
+                    continue
+                if len(frame) == 1:
+                    # a bare reply code, the server turned the tunnel away
+                    logger.warning('udp tunnel refused, error code %s', frame[0])
+                    CONNECTS.labels('client', frame[0]).inc()
+                    self.pool.replied(wsock, frame[0])
+                    break
+                for msg in unpack_batch(frame):
+                    if len(msg) < UDP_FLOW_HEADER.size:
+                        logger.warning('invalid udp flow datagram: %s', bytes(msg))
+                        continue
+                    self.dispatch(msg)
+        except PIPE_EXCEPTION as e:
+            logger.debug(e)
+        except Exception as e:
+            logger.exception(e)
+        finally:
+            for flow in list(self.flows.values()):
+                if flow.sender and flow.sender.wsock is wsock:
+                    self.remove_flow(flow)
+            await wsock.close()
+
+    async def expire(self):
+        while True:
+            await asyncio.sleep(UDP_CHECK_INTERVAL)
+            now = time.monotonic()
+            for flow in list(self.flows.values()):
+                if flow.pending is not None and now - flow.pending > UDP_REPLY_TIMEOUT:
+                    logger.debug('flow %s -> %s timeout', flow.src, flow.dst)
+                    UDP_TIMEOUTS.labels().inc()
+                    # only counted, one way flows keep their flow id and upstream port
+                    flow.pending = None
+                if now - flow.active > UDP_IDLE_TIMEOUT:
+                    self.remove_flow(flow)
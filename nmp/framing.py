@@ -0,0 +1,210 @@
+#!/bin/env python3
+
+'''
+Length prefixed frames over tls or plain tcp, a lighter transport than
+websockets: no http upgrade, no per frame masking, no permessage-deflate.
+
+   $ nmp --server nmp --port 8888 --frame-port 8443 --certfile cert.pem --keyfile key.pem
+   $ nmp --server sockv5 --endpoint tls://example.com:8443 --token TOKEN
+   $ nmp --server sockv5 --endpoint tcp://127.0.0.1:8443 --token TOKEN   # server without a certificate
+
+The first frame carries the /token/dummy path of the websocket url and
+goes out with the first request, after it every frame is one nmp message
+like a websocket message. Http proxies (Caddy, nginx) can't route these,
+keep wss:// endpoints behind them.
+'''
+
+import asyncio
+import struct
+from collections import deque
+from urllib.parse import urlsplit
+from nmp.log import get_logger
+from nmp.pipe import WEBSOCKET_MAX_QUEUE
+
+logger = get_logger(__name__)
+
+# ---------------------------------
+# | 1 bytes | 3 bytes |    ...    |
+# | opcode  | length  |  payload  |
+FRAME_HEADER = struct.Struct('!I')
+FRAME_DATA = 0
+FRAME_PING = 1
+FRAME_PONG = 2
+# the websockets default max_size
+MAX_FRAME_SIZE = 2 ** 20
+FRAME_CLOSE_TIMEOUT = 10
+PING_ID = struct.Struct('!I')
+# as websockets does for wss/ws
+DEFAULT_PORTS = {'tls': 443, 'tcp': 80}
+
+
+class FrameProtocol(asyncio.Protocol):
+    # quacks like the websockets connection: send/recv/ping/close, open,
+    # closed, remote_address and connection_lost_waiter
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.transport = None
+        # nothing to negotiate, compression finds no permessage-deflate
+        self.extensions = []
+        self.buffer = bytearray()
+        self.messages = deque()
+        self.eof = False
+        self.reading_paused = False
+        self.writing_paused = False
+        self.read_waiter = None
+        # every sender blocked by a paused transport, mux sessions have many
+        self.drain_waiters = deque()
+        self.pings = {}
+        self.next_ping = 0
+        self.connection_lost_waiter = asyncio.get_running_loop().create_future()
+        # done with the first frame from the peer
+        self.first_frame = asyncio.get_running_loop().create_future()
+
+    @property
+    def open(self):
+        return self.transport is not None and not self.eof and not self.transport.is_closing()
+
+    @property
+    def closed(self):
+        return self.connection_lost_waiter.done()
+
+    @property
+    def remote_address(self):
+        return self.transport.get_extra_info('peername') if self.transport else None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if self.callback:
+            asyncio.create_task(self.callback(self))
+
+    def data_received(self, data):
+        buffer = self.buffer
+        buffer.extend(data)
+        view = memoryview(buffer)
+        offset = 0
+        while len(buffer) - offset >= FRAME_HEADER.size:
+            header = FRAME_HEADER.unpack_from(buffer, offset)[0]
+            size = header & 0xffffff
+            if size > MAX_FRAME_SIZE:
+                logger.warning('frame of %s bytes from %s, close', size, self.remote_address)
+                view.release()
+                buffer.clear()
+                self.transport.close()
+                return
+            start = offset + FRAME_HEADER.size
+            if len(buffer) < start + size:
+                break
+            self.frame_received(header >> 24, bytes(view[start:start + size]))
+            offset = start + size
+        view.release()
+        del buffer[:offset]
+        if len(self.messages) >= WEBSOCKET_MAX_QUEUE and not self.reading_paused:
+            self.reading_paused = True
+            self.transport.pause_reading()
+        self.wakeup_reader()
+
+    def frame_received(self, opcode, payload):
+        if not self.first_frame.done():
+            self.first_frame.set_result(None)
+        if FRAME_DATA == opcode:
+            self.messages.append(payload)
+        elif FRAME_PING == opcode:
+            if not self.transport.is_closing():
+                self.write(FRAME_PONG, payload)
+        elif FRAME_PONG == opcode:
+            pong = self.pings.pop(payload, None)
+            if pong and not pong.done():
+                pong.set_result(None)
+        else:
+            logger.warning('unknown frame opcode %s', opcode)
+
+    def eof_received(self):
+        self.eof = True
+        self.wakeup_reader()
+
+    def connection_lost(self, exc):
+        self.eof = True
+        self.wakeup_reader()
+        self.resume_writing()
+        for pong in self.pings.values():
+            if not pong.done():
+                pong.set_exception(ConnectionResetError('Connection lost'))
+        self.pings = {}
+        if not self.connection_lost_waiter.done():
+            self.connection_lost_waiter.set_result(None)
+
+    def pause_writing(self):
+        self.writing_paused = True
+
+    def resume_writing(self):
+        self.writing_paused = False
+        while self.drain_waiters:
+            waiter = self.drain_waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def wakeup_reader(self):
+        if self.read_waiter and not self.read_waiter.done():
+            self.read_waiter.set_result(None)
+
+    def write(self, opcode, payload):
+        if self.transport.is_closing():
+            raise ConnectionResetError('Connection lost')
+        self.transport.writelines((FRAME_HEADER.pack(opcode << 24 | len(payload)), payload))
+
+    async def send(self, msg):
+        if isinstance(msg, memoryview):
+            # BufferedSocketStream reuses its buffers after recv()
+            msg = bytes(msg)
+        if len(msg) > MAX_FRAME_SIZE:
+            # one message is one frame, splitting would change what the peer receives
+            raise ValueError(f'message of {len(msg)} bytes is over the frame limit')
+        self.write(FRAME_DATA, msg)
+        if self.writing_paused:
+            waiter = asyncio.get_running_loop().create_future()
+            self.drain_waiters.append(waiter)
+            await waiter
+
+    async def recv(self):
+        while not self.messages:
+            if self.eof:
+                raise ConnectionResetError('Connection closed')
+            self.read_waiter = asyncio.get_running_loop().create_future()
+            await self.read_waiter
+        msg = self.messages.popleft()
+        if self.reading_paused and len(self.messages) < WEBSOCKET_MAX_QUEUE:
+            self.reading_paused = False
+            self.transport.resume_reading()
+        return msg
+
+    async def ping(self):
+        self.next_ping = (self.next_ping + 1) & 0xffffffff
+        payload = PING_ID.pack(self.next_ping)
+        pong = asyncio.get_running_loop().create_future()
+        self.pings[payload] = pong
+        self.write(FRAME_PING, payload)
+        return pong
+
+    async def close(self):
+        if not self.transport.is_closing():
+            self.transport.close()
+        try:
+            await asyncio.wait_for(asyncio.shield(self.connection_lost_waiter), FRAME_CLOSE_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.transport.abort()
+
+
+async def connect(url, path, ssl=None, server_hostname=None):
+    parts = urlsplit(url)
+    loop = asyncio.get_running_loop()
+    kwargs = {'ssl': ssl, 'server_hostname': server_hostname} if ssl else {}
+    _, fsock = await loop.create_connection(FrameProtocol, parts.hostname,
+                                           parts.port or DEFAULT_PORTS[parts.scheme], **kwargs)
+    # the token rides along with the first request, no round trip of its own
+    fsock.write(FRAME_DATA, path.encode())
+    return fsock
+
+
+async def serve(callback, sock, ssl=None):
+    loop = asyncio.get_running_loop()
+    return await loop.create_server(lambda: FrameProtocol(callback), sock=sock, ssl=ssl)
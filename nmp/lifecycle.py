@@ -0,0 +1,197 @@
+#!/bin/env python3
+
+'''
+Graceful stop and zero downtime restart:
+
+   $ kill -TERM <pid>   # stop accepting, exit once pipes are done or --drain-timeout passed
+   $ kill -USR2 <pid>   # start a new nmp with the same arguments, then drain
+
+Websockets of the nmp server without a transfer in flight, pre-warmed
+ones, mux sessions without streams and udp pipes, are closed when the
+drain starts and new requests on the others get NMP_CONNECT_OVERLOADED,
+so clients move on to the new process.
+
+On USR2 the listening sockets, including the tproxy IP_TRANSPARENT ones,
+are inherited by the new process, so connects are never refused. With
+--workers the supervisor restarts instead and the new workers share the
+ports with SO_REUSEPORT. The new process runs as a child of the old one,
+under systemd use KillMode=process or it is killed with the old one.
+'''
+
+import asyncio
+import os
+import select
+import socket
+import subprocess
+import sys
+import time
+import weakref
+from nmp.log import get_logger
+from nmp.metrics import PIPES_ACTIVE
+
+logger = get_logger(__name__)
+
+# name=fd,... of listening sockets handed over by the old process
+LISTEN_FDS_ENV = 'NMP_LISTEN_FDS'
+# the new process writes a byte per listening process to this pipe
+READY_FD_ENV = 'NMP_READY_FD'
+DRAIN_TIMEOUT = 30
+LISTEN_BACKLOG = 100
+DRAIN_CHECK_INTERVAL = 0.2
+READY_TIMEOUT = 30
+# datagram pipes of the nmp server live as long as the client, no transfer to wait for
+DATAGRAM_PIPES = ('udp', 'flow')
+
+
+def tcp_listen_socket(host, port, reuse_port=False):
+    family, _, _, _, addr = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM,
+                                               flags=socket.AI_PASSIVE)[0]
+    # IPPROTO_TCP rather than 0, asyncio only sets TCP_NODELAY on accepted
+    # sockets whose proto says tcp
+    sock = socket.socket(family, socket.SOCK_STREAM, socket.IPPROTO_TCP)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        if socket.AF_INET6 == family:
+            sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+        sock.bind(addr)
+        sock.listen(LISTEN_BACKLOG)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def active_pipes():
+    return sum(child.value for (kind,), child in PIPES_ACTIVE.children.items() if kind not in DATAGRAM_PIPES)
+
+
+def wait_ready(fd, count, timeout=READY_TIMEOUT):
+    deadline = time.monotonic() + timeout
+    received = 0
+    try:
+        while received < count:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+                return False
+            data = os.read(fd, count - received)
+            if not data:
+                return False
+            received += len(data)
+        return True
+    finally:
+        os.close(fd)
+
+
+class Lifecycle:
+    def __init__(self):
+        self.inherited = None
+        # name -> listening socket
+        self.sockets = {}
+        # closed to stop accepting
+        self.servers = []
+        self.draining = False
+        self.restarting = False
+        # websockets a drain closes at once
+        self.idle_sockets = weakref.WeakSet()
+
+    def inherit(self):
+        if self.inherited is None:
+            self.inherited = {}
+            for item in filter(None, os.environ.pop(LISTEN_FDS_ENV, '').split(',')):
+                name, fd = item.split('=')
+                self.inherited[name] = int(fd)
+        return self.inherited
+
+    def listen_socket(self, name, factory):
+        fd = self.inherit().pop(name, None)
+        if fd is not None:
+            sock = socket.socket(fileno=fd)
+            logger.info('inherited %s socket %s', name, sock.getsockname())
+        else:
+            sock = factory()
+        self.sockets[name] = sock
+        return sock
+
+    def add_server(self, server):
+        self.servers.append(server)
+
+    def release(self):
+        # inherited sockets nobody asked for
+        for fd in self.inherit().values():
+            os.close(fd)
+        self.inherited.clear()
+
+    def close_ready(self):
+        fd = os.environ.pop(READY_FD_ENV, None)
+        if fd:
+            os.close(int(fd))
+
+    def notify_ready(self):
+        self.release()
+        fd = os.environ.pop(READY_FD_ENV, None)
+        if fd:
+            os.write(int(fd), b'1')
+            os.close(int(fd))
+
+    def spawn(self, count):
+        # count: listening processes the new instance will start
+        r, w = os.pipe()
+        fds = {name: sock.fileno() for name, sock in self.sockets.items()}
+        env = dict(os.environ)
+        env[LISTEN_FDS_ENV] = ','.join(f'{name}={fd}' for name, fd in fds.items())
+        env[READY_FD_ENV] = str(w)
+        try:
+            process = subprocess.Popen([sys.executable, '-m', 'nmp.main', *sys.argv[1:]],
+                                       env=env, pass_fds=[*fds.values(), w])
+        finally:
+            os.close(w)
+        logger.info('started new process %s, handing over %s', process.pid, list(fds))
+        if wait_ready(r, count):
+            logger.info('new process %s is ready', process.pid)
+            return True
+        logger.error('new process %s not ready, keep serving', process.pid)
+        return False
+
+    async def restart(self, config):
+        if self.restarting or self.draining:
+            return False
+        self.restarting = True
+        try:
+            loop = asyncio.get_running_loop()
+            ready = await loop.run_in_executor(None, self.spawn, 1)
+        finally:
+            self.restarting = False
+        if ready:
+            await self.drain(config.drain_timeout)
+        return ready
+
+    def idle(self, wsock):
+        if self.draining:
+            asyncio.create_task(wsock.close())
+        else:
+            self.idle_sockets.add(wsock)
+
+    def busy(self, wsock):
+        self.idle_sockets.discard(wsock)
+
+    def stop_accepting(self):
+        for server in self.servers:
+            server.close()
+        self.servers = []
+
+    async def drain(self, timeout):
+        self.draining = True
+        self.stop_accepting()
+        for wsock in list(self.idle_sockets):
+            asyncio.create_task(wsock.close())
+        self.idle_sockets.clear()
+        deadline = time.monotonic() + timeout
+        logger.info('draining %s pipes for up to %ss', active_pipes(), timeout)
+        while active_pipes() > 0 and time.monotonic() < deadline:
+            await asyncio.sleep(DRAIN_CHECK_INTERVAL)
+        logger.info('drained, %s pipes left', active_pipes())
+
+
+LIFECYCLE = Lifecycle()
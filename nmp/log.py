@@ -1,16 +1,63 @@
 #!/usr/bin/env python3
 
+import atexit
 import logging
+import logging.handlers
+import queue
 import coloredlogs
 
 fmt = '[%(asctime)s,%(msecs)03d] [%(levelname)7s] [%(filename)s -- %(funcName)s():%(lineno)s] %(message)s'
 coloredlogs.DEFAULT_FIELD_STYLES['levelname'] = {'bold': True}
 
+ROOT_LOGGER = 'nmp'
+LOG_LEVELS = {
+    'debug': logging.DEBUG,
+    'info': logging.INFO,
+    'warning': logging.WARNING,
+    'error': logging.ERROR,
+}
 
-def get_logger(name: str = None) -> logging.Logger:
-    logger = logging.getLogger(name)
-    coloredlogs.install(level=logging.INFO,
+listener = None
+
+
+def stop_listener():
+    global listener
+    if listener:
+        listener.stop()
+        listener = None
+
+
+def setup_logging(level: str = 'info', use_queue: bool = False) -> None:
+    # handlers live on the 'nmp' logger only, module loggers propagate to it
+    global listener
+    stop_listener()
+    root = logging.getLogger(ROOT_LOGGER)
+    root.handlers.clear()
+    root.propagate = False
+    coloredlogs.install(level=LOG_LEVELS[level],
                         fmt=fmt,
                         milliseconds=True,
-                        logger=logger)
-    return logger
\ No newline at end of file
+                        logger=root)
+    root.setLevel(LOG_LEVELS[level])
+    if not use_queue:
+        return
+
+    # format and write records on a thread, never on the event loop
+    handlers = root.handlers[:]
+    root.handlers.clear()
+    records = queue.SimpleQueue()
+    root.addHandler(logging.handlers.QueueHandler(records))
+    listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    listener.start()
+
+
+def get_logger(name: str = None) -> logging.Logger:
+    if not name or name == '__main__':
+        return logging.getLogger(ROOT_LOGGER)
+    if name != ROOT_LOGGER and not name.startswith(ROOT_LOGGER + '.'):
+        name = f'{ROOT_LOGGER}.{name}'
+    return logging.getLogger(name)
+
+
+setup_logging()
+atexit.register(stop_listener)
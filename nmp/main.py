@@ -7,10 +7,20 @@ import os
 import signal
 import sys
 from pathlib import Path
-from nmp.log import get_logger
+from nmp import metrics
+from nmp.admission import ADMISSION_QUEUE, parse_proxies
+from nmp.balancer import BALANCE_MODES
+from nmp.compression import COMPRESSION_MODES
+from nmp.lifecycle import DRAIN_TIMEOUT, LIFECYCLE
+from nmp.log import LOG_LEVELS, get_logger, setup_logging
+from nmp.pipe import HANDSHAKE_TIMEOUT, MAX_UDP_FLOW_ASSOCIATION, PIPE_IDLE_TIMEOUT, STREAM_TYPES
+from nmp.resolver import DNS_CACHE_SIZE, DNS_TTL
+from nmp.rules import RULE_CACHE_SIZE
 from nmp.server import NmpServer
+from nmp.shaper import parse_rate
 from nmp.sockv5 import SockV5Server
 from nmp.transparent import TransparentServer
+from nmp.worker import Supervisor, worker_metrics_port
 
 logger = get_logger(__name__)
 
@@ -18,14 +28,48 @@ logger = get_logger(__name__)
 class Config:
     def __init__(self):
         self.uvloop = False
+        self.log_level = 'info'
+        self.log_queue = False
+        self.metrics_port = None
+        self.idle_timeout = PIPE_IDLE_TIMEOUT
+        self.handshake_timeout = HANDSHAKE_TIMEOUT
+        self.drain_timeout = DRAIN_TIMEOUT
+        self.workers = 0
+        # set in forked workers only
+        self.worker = None
         self.server = None
         self.host = '127.0.0.1'
         self.port = 8888
         # for sockv5
         self.endpoint = None
+        self.balance = 'ewma'
         self.token = None
+        self.mux = 0
+        self.pool_size = 0
+        self.stream = 'default'
+        self.coalesce_delay = 0
+        self.coalesce_size = 2 ** 14
+        self.fast_open = False
+        self.compression = 'adaptive'
+        self.tls13 = False
+        self.cafile = None
+        self.rules = None
+        self.rule_cache_size = RULE_CACHE_SIZE
         # for nmp server
         self.conf = os.path.join(Path.home(), '.NMP_TOKEN')
+        self.dns_ttl = DNS_TTL
+        self.dns_cache_size = DNS_CACHE_SIZE
+        self.udp_associations = MAX_UDP_FLOW_ASSOCIATION
+        self.certfile = None
+        self.keyfile = None
+        self.frame_port = None
+        self.rate_limit = None
+        self.client_rate_limit = None
+        self.max_tunnels = 0
+        self.max_connects = 0
+        self.client_max_tunnels = 0
+        self.admission_queue = ADMISSION_QUEUE
+        self.trusted_proxies = None
 
     def from_args(self):
         parser = argparse.ArgumentParser()
@@ -36,9 +80,74 @@ class Config:
         parser.add_argument('--port', dest='port',
                             help='bind port (default: 8888)')
         parser.add_argument('--endpoint', dest='endpoint',
-                            help='nmp server endpoint (wss://example.com)')
+                            help='nmp server endpoints, comma separated (wss://a.example.com,wss://b.example.com), '
+                                 'tls://host:port or tcp://host:port for a --frame-port')
+        parser.add_argument('--balance', dest='balance',
+                            help='endpoint selection: ewma/least-conn (default: ewma)')
         parser.add_argument('--token', dest='token', help='nmp server token')
+        parser.add_argument('--mux', dest='mux',
+                            help='multiplex tcp streams over N websockets (default: 0, disabled)')
+        parser.add_argument('--pool-size', dest='pool_size',
+                            help='pre-warmed websockets kept ready (default: 0, disabled)')
+        parser.add_argument('--stream', dest='stream',
+                            help='tcp stream implementation: default/buffered (default: default)')
+        parser.add_argument('--coalesce-delay', dest='coalesce_delay',
+                            help='coalesce small writes into one frame for N ms (default: 0, disabled)')
+        parser.add_argument('--coalesce-size', dest='coalesce_size',
+                            help='flush coalesced writes at N bytes (default: 16384)')
+        parser.add_argument('--fast-open', dest='fast_open',
+                            help='reply to clients before the tunnel is connected, sockv5/tproxy')
+        parser.add_argument('--compression', dest='compression',
+                            help='permessage-deflate: off/on/adaptive (default: adaptive)')
+        parser.add_argument('--tls13', dest='tls13', help='allow tls 1.3 to the endpoint')
+        parser.add_argument('--cafile', dest='cafile',
+                            help='verify the endpoint with these ca certificates (default: system)')
+        parser.add_argument('--rules', dest='rules',
+                            help='connect matching targets directly, comma separated rule files, sockv5/tproxy')
+        parser.add_argument('--rule-cache-size', dest='rule_cache_size',
+                            help=f'max cached routing decisions (default: {RULE_CACHE_SIZE})')
+        parser.add_argument('--certfile', dest='certfile', help='nmp server tls certificate chain')
+        parser.add_argument('--keyfile', dest='keyfile', help='nmp server tls private key')
+        parser.add_argument('--frame-port', dest='frame_port',
+                            help='nmp server also serves length prefixed frames on port N, tls with --certfile')
+        parser.add_argument('--dns-ttl', dest='dns_ttl',
+                            help=f'seconds to cache resolved upstream hosts (default: {DNS_TTL})')
+        parser.add_argument('--dns-cache-size', dest='dns_cache_size',
+                            help=f'max cached upstream hosts, 0 disables (default: {DNS_CACHE_SIZE})')
+        parser.add_argument('--udp-associations', dest='udp_associations',
+                            help=f'nmp server upstream udp sockets per flow websocket (default: {MAX_UDP_FLOW_ASSOCIATION})')
+        parser.add_argument('--rate-limit', dest='rate_limit',
+                            help='nmp server bandwidth in KB/s, DOWN[,UP] (default: unlimited)')
+        parser.add_argument('--client-rate-limit', dest='client_rate_limit',
+                            help='nmp server bandwidth per client ip in KB/s, DOWN[,UP] (default: unlimited)')
+        parser.add_argument('--max-tunnels', dest='max_tunnels',
+                            help='nmp server concurrent tunnels (default: 0, unlimited)')
+        parser.add_argument('--max-connects', dest='max_connects',
+                            help='nmp server upstream connects in flight (default: 0, unlimited)')
+        parser.add_argument('--client-max-tunnels', dest='client_max_tunnels',
+                            help='nmp server concurrent tunnels per client ip (default: 0, unlimited)')
+        parser.add_argument('--admission-queue', dest='admission_queue',
+                            help=f'nmp server requests waiting for a tunnel or connect slot (default: {ADMISSION_QUEUE})')
+        parser.add_argument('--trusted-proxies', dest='trusted_proxies',
+                            help='nmp server takes the client ip from X-Forwarded-For of these proxies, '
+                                 'comma separated addresses or networks (default: none)')
+        parser.add_argument('--idle-timeout', dest='idle_timeout',
+                            help=f'close pipes idle for N seconds, 0 disables (default: {PIPE_IDLE_TIMEOUT})')
+        parser.add_argument('--handshake-timeout', dest='handshake_timeout',
+                            help=f'close sockv5 clients not done with the handshake in N seconds (default: {HANDSHAKE_TIMEOUT})')
         parser.add_argument('--uvloop', dest='uvloop', help='use uvloop')
+        parser.add_argument('--drain-timeout', dest='drain_timeout',
+                            help=f'on SIGTERM wait up to N seconds for open pipes, 0 stops at once (default: {DRAIN_TIMEOUT})')
+        parser.add_argument('--workers', dest='workers',
+                            help='fork N workers sharing the port with SO_REUSEPORT (default: 0, single process)')
+        parser.add_argument('--metrics-port', dest='metrics_port',
+                            help='serve prometheus metrics on 127.0.0.1:N/metrics')
+        parser.add_argument('--log-level', dest='log_level',
+                            help='log level: debug/info/warning/error (default: info)')
+        parser.add_argument('--log-queue', dest='log_queue',
+                            help='write logs from a background thread')
+        parser.add_argument('--quiet', dest='quiet',
+                            help='production logging, same as --log-level warning --log-queue yes')
         args = parser.parse_args()
         if args.server:
             self.server = args.server
@@ -48,10 +157,77 @@ class Config:
             self.port = int(args.port)
         if args.endpoint:
             self.endpoint = args.endpoint
+        if args.balance:
+            self.balance = args.balance
         if args.token:
             self.token = args.token
+        if args.mux:
+            self.mux = int(args.mux)
+        if args.pool_size:
+            self.pool_size = int(args.pool_size)
+        if args.stream:
+            self.stream = args.stream
+        if args.coalesce_delay:
+            self.coalesce_delay = float(args.coalesce_delay)
+        if args.coalesce_size:
+            self.coalesce_size = int(args.coalesce_size)
+        if args.fast_open and 'yes' == args.fast_open:
+            self.fast_open = True
+        if args.compression:
+            self.compression = args.compression
+        if args.tls13 and 'yes' == args.tls13:
+            self.tls13 = True
+        if args.cafile:
+            self.cafile = args.cafile
+        if args.rules:
+            self.rules = args.rules
+        if args.rule_cache_size:
+            self.rule_cache_size = int(args.rule_cache_size)
+        if args.certfile:
+            self.certfile = args.certfile
+        if args.keyfile:
+            self.keyfile = args.keyfile
+        if args.frame_port:
+            self.frame_port = int(args.frame_port)
+        if args.dns_ttl:
+            self.dns_ttl = float(args.dns_ttl)
+        if args.dns_cache_size:
+            self.dns_cache_size = int(args.dns_cache_size)
+        if args.udp_associations:
+            self.udp_associations = int(args.udp_associations)
+        if args.rate_limit:
+            self.rate_limit = args.rate_limit
+        if args.client_rate_limit:
+            self.client_rate_limit = args.client_rate_limit
+        if args.max_tunnels:
+            self.max_tunnels = int(args.max_tunnels)
+        if args.max_connects:
+            self.max_connects = int(args.max_connects)
+        if args.client_max_tunnels:
+            self.client_max_tunnels = int(args.client_max_tunnels)
+        if args.admission_queue:
+            self.admission_queue = int(args.admission_queue)
+        if args.trusted_proxies:
+            self.trusted_proxies = args.trusted_proxies
+        if args.idle_timeout:
+            self.idle_timeout = float(args.idle_timeout)
+        if args.handshake_timeout:
+            self.handshake_timeout = float(args.handshake_timeout)
         if args.uvloop and 'yes' == args.uvloop:
             self.uvloop = True
+        if args.drain_timeout:
+            self.drain_timeout = float(args.drain_timeout)
+        if args.workers:
+            self.workers = int(args.workers)
+        if args.metrics_port:
+            self.metrics_port = int(args.metrics_port)
+        if args.log_level:
+            self.log_level = args.log_level
+        if args.log_queue and 'yes' == args.log_queue:
+            self.log_queue = True
+        if args.quiet and 'yes' == args.quiet:
+            self.log_level = 'warning'
+            self.log_queue = True
 
         if not self.validate():
             parser.print_help()
@@ -60,51 +236,111 @@ class Config:
     def validate(self):
         if not self.server:
             return False
+        if self.stream not in STREAM_TYPES:
+            return False
+        if self.log_level not in LOG_LEVELS:
+            return False
+        if self.compression not in COMPRESSION_MODES:
+            return False
+        if self.balance not in BALANCE_MODES:
+            return False
+        try:
+            parse_rate(self.rate_limit)
+            parse_rate(self.client_rate_limit)
+            parse_proxies(self.trusted_proxies)
+        except ValueError:
+            return False
         if self.server == 'sockv5' or self.server == 'tproxy':
             return self.endpoint and self.token
         return True
 
 
-def add_stop_signal():
+def add_stop_signal(config):
     def shutdown(name, loop):
-        logger.info(f'stop for signal: {name}')
-        logger.info(f'cancel {len(asyncio.all_tasks())} tasks')
+        if config.drain_timeout > 0 and not LIFECYCLE.draining:
+            # a second signal stops at once
+            logger.info('drain for signal: %s', name)
+            task = asyncio.create_task(LIFECYCLE.drain(config.drain_timeout))
+            task.add_done_callback(lambda _: loop.stop())
+            return
+        logger.info('stop for signal: %s', name)
+        logger.info('cancel %s tasks', len(asyncio.all_tasks()))
         loop.stop()
 
+    def restart(loop):
+        logger.info('restart for signal: SIGUSR2')
+        task = asyncio.create_task(LIFECYCLE.restart(config))
+        task.add_done_callback(lambda t: t.result() and loop.stop())
+
     loop = asyncio.get_running_loop()
     for name in ('SIGINT', 'SIGTERM'):
         loop.add_signal_handler(
             getattr(signal, name),
             functools.partial(shutdown, name, loop))
+    if config.worker is None:
+        # workers are restarted by the supervisor
+        loop.add_signal_handler(signal.SIGUSR2, functools.partial(restart, loop))
+
+
+async def start_metrics_server(config):
+    if not config.metrics_port:
+        return
+    port = config.metrics_port
+    if config.worker is not None:
+        # the supervisor merges worker metrics on config.metrics_port
+        port = worker_metrics_port(config, config.worker)
+        metrics.WORKERS.labels().set(1)
+    # shared with the next process during a restart
+    await metrics.start_metrics_server('127.0.0.1', port, reuse_port=True)
 
 
 async def start_nmp_server(config):
-    logger.info(f'start nmp server: ({config.host}:{config.port})')
-    add_stop_signal()
+    logger.info('start nmp server: (%s:%s)', config.host, config.port)
+    add_stop_signal(config)
+    await start_metrics_server(config)
     nmp = NmpServer(config)
     await nmp.start_server()
 
 
 async def start_sockv5_server(config):
-    logger.info(f'start sockv5 server: ({config.host}:{config.port})')
-    add_stop_signal()
+    logger.info('start sockv5 server: (%s:%s)', config.host, config.port)
+    add_stop_signal(config)
+    await start_metrics_server(config)
     sockv5 = SockV5Server(config)
     await sockv5.start_server()
 
 
 async def start_transparent_server(config):
-    logger.info(f'start transparent server: ({config.host}:{config.port})')
-    add_stop_signal()
+    logger.info('start transparent server: (%s:%s)', config.host, config.port)
+    add_stop_signal(config)
+    await start_metrics_server(config)
     transparent = TransparentServer(config)
     await transparent.start_server()
 
 
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        from nmp.bench import main as bench_main
+        bench_main(sys.argv[2:])
+        return
+
     config = Config()
     config.from_args()
+    setup_logging(config.log_level, config.log_queue)
     if config.uvloop:
         import uvloop
         uvloop.install()
+    if config.workers > 0:
+        if config.server == 'nmp':
+            # workers must share one token
+            NmpServer(config).load_token()
+        Supervisor(config, run_server).run()
+        logger.info('stoped')
+        return
+    run_server(config)
+
+
+def run_server(config):
     try:
         if config.server == 'sockv5':
             asyncio.run(start_sockv5_server(config))
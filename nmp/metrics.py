@@ -0,0 +1,225 @@
+#!/bin/env python3
+
+import asyncio
+import functools
+from bisect import bisect_left
+from nmp.log import get_logger
+
+logger = get_logger(__name__)
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+REGISTRY = []
+
+
+class Value:
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, value=1):
+        self.value += value
+
+    def dec(self, value=1):
+        self.value -= value
+
+    def set(self, value):
+        self.value = value
+
+
+class Buckets:
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metric:
+    type = 'untyped'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labels
+        self.children = {}
+        REGISTRY.append(self)
+
+    def new_child(self):
+        return Value()
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = self.new_child()
+        return child
+
+    def format_labels(self, values, extra=()):
+        pairs = list(zip(self.labelnames, values)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+
+    def samples(self):
+        for values, child in sorted(self.children.items()):
+            yield self.name, self.format_labels(values), child.value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+        for name, labels, value in self.samples():
+            lines.append(f'{name}{labels} {value}')
+        return lines
+
+
+class Counter(Metric):
+    type = 'counter'
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, help, labels)
+
+    def new_child(self):
+        return Buckets(self.buckets)
+
+    def samples(self):
+        for values, child in sorted(self.children.items()):
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), child.counts):
+                total += count
+                yield f'{self.name}_bucket', self.format_labels(values, [('le', bound)]), total
+            yield f'{self.name}_sum', self.format_labels(values), child.sum
+            yield f'{self.name}_count', self.format_labels(values), child.count
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    lines.append('')
+    return '\n'.join(lines).encode()
+
+
+def merge(texts):
+    # sum samples with the same name and labels, families keep their order
+    families = {}
+    for text in texts:
+        family = None
+        for line in text.decode().splitlines():
+            if line.startswith('# HELP '):
+                family = families.setdefault(line.split()[2], ([], {}))
+            if family is None or not line:
+                continue
+            header, samples = family
+            if line.startswith('#'):
+                if line not in header:
+                    header.append(line)
+                continue
+            key, value = line.rsplit(' ', 1)
+            samples[key] = samples.get(key, 0) + float(value)
+
+    lines = []
+    for header, samples in families.values():
+        lines.extend(header)
+        for key, value in samples.items():
+            lines.append(f'{key} {int(value) if value.is_integer() else value}')
+    lines.append('')
+    return '\n'.join(lines).encode()
+
+
+async def collect():
+    return render()
+
+
+async def scrape(host, port):
+    r, w = await asyncio.open_connection(host, port)
+    try:
+        w.write(b'GET /metrics HTTP/1.1\r\nHost: ' + host.encode() + b'\r\n\r\n')
+        data = await r.read()
+    finally:
+        w.close()
+    return data.split(b'\r\n\r\n', 1)[1]
+
+
+async def collect_workers(host, ports):
+    texts = [render()]
+    for text in await asyncio.gather(*[scrape(host, port) for port in ports],
+                                     return_exceptions=True):
+        # a restarting worker is left out until it is back
+        if isinstance(text, bytes):
+            texts.append(text)
+    return merge(texts)
+
+
+PIPES_ACTIVE = Gauge('nmp_pipes_active', 'Active pipes', ('type',))
+PIPE_BYTES = Counter('nmp_pipe_bytes_total', 'Bytes relayed by pipes', ('type', 'direction'))
+CONNECTS = Counter('nmp_connect_total', 'Tunnel connects by NMP code', ('side', 'code'))
+HANDSHAKE_SECONDS = Histogram('nmp_websocket_handshake_seconds', 'Websocket handshake time')
+UPSTREAM_CONNECT_SECONDS = Histogram('nmp_upstream_connect_seconds', 'Upstream connect time')
+UDP_RTT_SECONDS = Histogram('nmp_udp_rtt_seconds', 'UDP tunnel round trip time')
+UDP_TIMEOUTS = Counter('nmp_udp_timeout_total', 'UDP flows without reply')
+REPLY_SOCKETS = Counter('nmp_reply_socket_total', 'Transparent reply socket lookups', ('result',))
+POOL_WAIT_SECONDS = Histogram('nmp_pool_wait_seconds', 'Time waiting for a pooled websocket')
+POOL_CONNECTIONS = Counter('nmp_pool_connections_total', 'Pre-warmed pool lookups', ('result',))
+COALESCE_CHUNKS = Counter('nmp_coalesce_chunks_total', 'Chunks given to coalescing writers')
+COALESCE_FRAMES = Counter('nmp_coalesce_frames_total', 'Frames written by coalescing writers')
+COALESCE_BYTES = Counter('nmp_coalesce_bytes_total', 'Bytes written by coalescing writers')
+DNS_LOOKUPS = Counter('nmp_dns_lookup_total', 'Resolver lookups by cache result', ('result',))
+DNS_RESOLVE_SECONDS = Histogram('nmp_dns_resolve_seconds', 'Resolver cache miss latency')
+DNS_CACHE_ENTRIES = Gauge('nmp_dns_cache_entries', 'Resolver cache entries')
+DEFLATE_BYTES = Counter('nmp_deflate_bytes_total', 'Permessage-deflate bytes by stage', ('op', 'stage'))
+DEFLATE_SECONDS = Counter('nmp_deflate_seconds_total', 'Time spent in permessage-deflate', ('op',))
+DEFLATE_DECISIONS = Counter('nmp_deflate_decision_total', 'Adaptive compression decisions', ('decision',))
+TLS_HANDSHAKES = Counter('nmp_tls_handshake_total', 'Client tls handshakes', ('scheme', 'session'))
+ROUTE_DECISIONS = Counter('nmp_route_total', 'Client routing decisions', ('action',))
+ENDPOINT_LATENCY = Gauge('nmp_endpoint_latency_seconds', 'Endpoint handshake latency ewma', ('endpoint',))
+ENDPOINT_OUTSTANDING = Gauge('nmp_endpoint_outstanding', 'Open websockets per endpoint', ('endpoint',))
+ENDPOINT_FAILURES = Counter('nmp_endpoint_failure_total', 'Failed endpoint handshakes', ('endpoint',))
+ENDPOINT_QUARANTINED = Gauge('nmp_endpoint_quarantined', 'Endpoints in quarantine', ('endpoint',))
+THROTTLED_BYTES = Counter('nmp_throttled_bytes_total', 'Bytes held back by rate limits', ('direction', 'limit'))
+THROTTLE_SECONDS = Counter('nmp_throttle_seconds_total', 'Time pipes waited for rate limits', ('direction', 'limit'))
+ADMISSIONS = Counter('nmp_admission_total', 'Admission control decisions', ('limit', 'result'))
+ADMISSION_ACTIVE = Gauge('nmp_admission_active', 'Slots held per admission limit', ('limit',))
+ENDPOINT_OVERLOADS = Counter('nmp_endpoint_overload_total', 'Overloaded replies per endpoint', ('endpoint',))
+REAPED = Counter('nmp_reaped_total', 'Connections closed by timeouts', ('type', 'reason'))
+WORKERS = Gauge('nmp_workers', 'Running worker processes')
+
+
+async def metrics_handler(r, w, collect=collect):
+    try:
+        line = await r.readline()
+        while (await r.readline()).strip():
+            pass
+        if line.split()[1:2] == [b'/metrics']:
+            body = await collect()
+            status = b'200 OK'
+        else:
+            body = b'not found\n'
+            status = b'404 Not Found'
+        w.write(b'HTTP/1.1 ' + status + b'\r\n'
+                + f'Content-Type: {CONTENT_TYPE}\r\n'.encode()
+                + f'Content-Length: {len(body)}\r\n'.encode()
+                + b'Connection: close\r\n\r\n' + body)
+        await w.drain()
+    except Exception as e:
+        logger.debug(e)
+    finally:
+        w.close()
+
+
+async def start_metrics_server(host, port, collect=collect, **kwargs):
+    logger.info('start metrics server: (%s:%s)', host, port)
+    return await asyncio.start_server(functools.partial(metrics_handler, collect=collect),
+                                      host, port, **kwargs)
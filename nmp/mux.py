@@ -0,0 +1,239 @@
+#!/bin/env python3
+
+import asyncio
+import struct
+from collections import deque
+from nmp.log import get_logger
+from nmp.metrics import CONNECTS
+from nmp.pipe import PIPE_EXCEPTION
+from nmp.proto import MUX_CLOSE, MUX_DATA, MUX_OPEN, MUX_REPLY, MUX_WINDOW, NMP_CONNECT_FAILED, NMP_CONNECT_OK, NMP_MUX_PIPE
+
+logger = get_logger(__name__)
+
+MUX_FRAME_SIZE = 2 ** 16
+MUX_WINDOW_SIZE = 2 ** 18
+
+# ---------------------------------
+# | 1 bytes | 4 bytes  |   ...   |
+# |   cmd   | stream id | payload |
+FRAME_HEADER = struct.Struct('!BI')
+WINDOW_UPDATE = struct.Struct('!I')
+
+
+class MuxStream:
+    # a deque and two waiters instead of asyncio.Queue and asyncio.Event,
+    # idle streams are the common case
+    __slots__ = ('session', 'stream_id', 'buffer', 'read_waiter', 'write_waiter', 'reply',
+                 'window', 'consumed', 'closed', 'remote_closed')
+
+    def __init__(self, session, stream_id):
+        self.session = session
+        self.stream_id = stream_id
+        self.buffer = deque()
+        self.read_waiter = None
+        self.write_waiter = None
+        self.reply = asyncio.get_running_loop().create_future()
+        self.window = MUX_WINDOW_SIZE
+        self.consumed = 0
+        self.closed = False
+        self.remote_closed = False
+
+    @staticmethod
+    def wakeup(waiter):
+        if waiter and not waiter.done():
+            waiter.set_result(None)
+
+    async def send(self, msg):
+        view = memoryview(msg)
+        while len(view) and not self.closed:
+            if self.window <= 0:
+                self.write_waiter = asyncio.get_running_loop().create_future()
+                await self.write_waiter
+                continue
+            size = min(len(view), self.window, MUX_FRAME_SIZE)
+            self.window -= size
+            await self.session.send_frame(MUX_DATA, self.stream_id, view[:size])
+            view = view[size:]
+
+    async def recv(self):
+        while not self.buffer:
+            self.read_waiter = asyncio.get_running_loop().create_future()
+            await self.read_waiter
+        msg = self.buffer.popleft()
+        self.consumed += len(msg)
+        if self.consumed >= MUX_WINDOW_SIZE // 2 and not self.closed:
+            await self.session.send_frame(MUX_WINDOW, self.stream_id,
+                                          WINDOW_UPDATE.pack(self.consumed))
+            self.consumed = 0
+        return msg
+
+    async def accept(self, code):
+        await self.session.send_frame(MUX_REPLY, self.stream_id, struct.pack('!B', code))
+        if code != NMP_CONNECT_OK:
+            self.remote_closed = True
+            await self.close()
+
+    async def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.session.streams.pop(self.stream_id, None)
+        self.buffer.append(b'')
+        self.wakeup(self.read_waiter)
+        self.wakeup(self.write_waiter)
+        if not self.remote_closed and not self.session.closed:
+            try:
+                await self.session.send_frame(MUX_CLOSE, self.stream_id)
+            except PIPE_EXCEPTION:
+                pass
+
+    def on_data(self, payload):
+        if len(payload):
+            self.buffer.append(payload)
+            self.wakeup(self.read_waiter)
+
+    def on_window(self, payload):
+        self.window += WINDOW_UPDATE.unpack(payload)[0]
+        self.wakeup(self.write_waiter)
+
+    def on_reply(self, payload):
+        if not self.reply.done():
+            self.reply.set_result(payload[0])
+        # fast open streams are used before the reply arrives
+        if payload[0] != NMP_CONNECT_OK and not self.closed:
+            self.on_close()
+
+    def on_close(self):
+        self.remote_closed = True
+        self.closed = True
+        self.session.streams.pop(self.stream_id, None)
+        self.buffer.append(b'')
+        self.wakeup(self.read_waiter)
+        self.wakeup(self.write_waiter)
+        self.on_reply(struct.pack('!B', NMP_CONNECT_FAILED))
+
+
+class MuxSession:
+    def __init__(self, wsock, acceptor=None, on_reply=None):
+        self.wsock = wsock
+        self.acceptor = acceptor
+        # client side, called with the websocket and the reply code of every stream
+        self.on_reply = on_reply
+        self.streams = {}
+        self.next_id = 1
+        self.closed = False
+
+    async def send_frame(self, cmd, stream_id, payload=b''):
+        frame = bytearray(FRAME_HEADER.pack(cmd, stream_id))
+        frame.extend(payload)
+        await self.wsock.send(frame)
+
+    async def open_stream(self, req, wait=True):
+        stream_id = self.next_id
+        self.next_id += 2
+        stream = MuxStream(self, stream_id)
+        self.streams[stream_id] = stream
+        await self.send_frame(MUX_OPEN, stream_id, req)
+        if self.on_reply:
+            stream.reply.add_done_callback(lambda f: self.on_reply(self.wsock, f.result()))
+        if not wait:
+            stream.reply.add_done_callback(lambda f: CONNECTS.labels('client', f.result()).inc())
+            return stream
+
+        code = await stream.reply
+        CONNECTS.labels('client', code).inc()
+        if code != NMP_CONNECT_OK:
+            logger.warning('connect refused, error code %s', code)
+            stream.remote_closed = True
+            await stream.close()
+            return None
+        return stream
+
+    def dispatch(self, msg):
+        cmd, stream_id = FRAME_HEADER.unpack_from(msg)
+        payload = msg[FRAME_HEADER.size:]
+        if cmd == MUX_OPEN:
+            if not self.acceptor or stream_id in self.streams:
+                return
+            stream = MuxStream(self, stream_id)
+            self.streams[stream_id] = stream
+            asyncio.create_task(self.accept(stream, payload))
+            return
+
+        stream = self.streams.get(stream_id)
+        if not stream:
+            return
+        if cmd == MUX_DATA:
+            stream.on_data(payload)
+        elif cmd == MUX_WINDOW:
+            stream.on_window(payload)
+        elif cmd == MUX_REPLY:
+            stream.on_reply(payload)
+        elif cmd == MUX_CLOSE:
+            stream.on_close()
+        else:
+            logger.error('not supported mux cmd[%s]', cmd)
+
+    async def accept(self, stream, req):
+        try:
+            await self.acceptor(stream, req)
+        except Exception as e:
+            logger.exception(e)
+            await stream.close()
+
+    async def run(self):
+        try:
+            while True:
+                msg = await self.wsock.recv()
+                if not isinstance(msg, bytes) or len(msg) < FRAME_HEADER.size:
+                    logger.warning('invalid mux frame: %s', msg)
+                    continue
+                self.dispatch(msg)
+        except PIPE_EXCEPTION as e:
+            logger.debug(e)
+        except Exception as e:
+            logger.exception(e)
+        finally:
+            self.closed = True
+            for stream in list(self.streams.values()):
+                stream.on_close()
+            await self.wsock.close()
+
+
+class MuxClient:
+    def __init__(self, pool, size):
+        self.pool = pool
+        self.size = size
+        self.sessions = []
+        self.lock = asyncio.Lock()
+
+    async def new_session(self):
+        wsock = await self.pool.new_connection()
+        if not wsock:
+            return None
+        await wsock.send(struct.pack('!B', NMP_MUX_PIPE))
+        session = MuxSession(wsock, on_reply=self.pool.replied)
+        asyncio.create_task(session.run())
+        self.sessions.append(session)
+        logger.debug('new mux session, total %s', len(self.sessions))
+        return session
+
+    async def get_session(self):
+        self.sessions = [s for s in self.sessions if not s.closed]
+        if len(self.sessions) < self.size:
+            async with self.lock:
+                self.sessions = [s for s in self.sessions if not s.closed]
+                if len(self.sessions) < self.size:
+                    return await self.new_session()
+        return min(self.sessions, key=lambda s: len(s.streams))
+
+    async def close(self):
+        for session in self.sessions:
+            await session.wsock.close()
+        self.sessions = []
+
+    async def open_stream(self, req, wait=True):
+        session = await self.get_session()
+        if not session:
+            return None
+        return await session.open_stream(req, wait)
@@ -1,46 +1,210 @@
 #!/bin/env python3
 
 import asyncio
+import logging
 import socket
 import struct
 import websockets
+from collections import OrderedDict
 from nmp.log import get_logger
+from nmp.metrics import COALESCE_BYTES, COALESCE_CHUNKS, COALESCE_FRAMES, PIPE_BYTES, PIPES_ACTIVE, REAPED
 from nmp.proto import NMP_CONNECT_FAILED, NMP_CONNECT_OK
+from nmp.timer import TIMERS
+
+logger = get_logger(__name__)
 
 BUFFER_SIZE = 2 ** 16
+# received messages websockets buffers per connection, the default is 32
+WEBSOCKET_MAX_QUEUE = 2 ** 3
+# off, ssh or imap idle tunnels stay quiet for long, --idle-timeout turns it on
+PIPE_IDLE_TIMEOUT = 0
+HANDSHAKE_TIMEOUT = 10
+UDP_IDLE_TIMEOUT = 60
+MAX_UDP_ASSOCIATION = 2 ** 8
+# flow websockets carry the flows of a whole client, MAX_UDP_TUNNEL of them.
+# evicting a live flow rebinds its source port and breaks quic or voip
+MAX_UDP_FLOW_ASSOCIATION = 2 ** 14
+MAX_UDP_REPLY_QUEUE = 2 ** 10
+# how long fast open waits for the first client payload, protocols
+# where the server speaks first send nothing
+FAST_OPEN_WAIT = 0.05
+
+# ----------------------------------------------
+# | 2 bytes | 1 bytes  |    ...    |    ...    |
+# |  port   | host len | ip/domain |  payload  |
+FAST_OPEN_HEADER = struct.Struct('!HB')
 
 
 class SocketStream:
+    __slots__ = ('reader', 'writer', 'closed')
+
     def __init__(self, reader, writer):
-        self.logger = get_logger(__name__)
         self.reader = reader
         self.writer = writer
         self.closed = False
 
     async def send(self, msg):
+        if isinstance(msg, memoryview):
+            # BufferedSocketStream reuses its buffers after recv()
+            msg = bytes(msg)
         self.writer.write(msg)
         await self.writer.drain()
 
     async def recv(self):
-        self.logger.debug('recv')
-        msg = await self.reader.read(BUFFER_SIZE)
-        self.logger.debug(msg)
-        return msg
+        return await self.reader.read(BUFFER_SIZE)
 
     async def close(self):
         self.closed = True
         self.writer.close()
         await self.writer.wait_closed()
 
+    def get_extra_info(self, name):
+        return self.writer.get_extra_info(name)
+
     @staticmethod
-    async def open_connection(host, port):
+    async def open_connection(host=None, port=None, **kwargs):
         try:
-            r, w = await asyncio.open_connection(host, port)
+            r, w = await asyncio.open_connection(host, port, **kwargs)
             return SocketStream(r, w)
         except Exception as e:
-            get_logger(__name__).exception(e)
+            logger.exception(e)
+            return None
+
+    @staticmethod
+    async def start_server(callback, host=None, port=None, **kwargs):
+        return await asyncio.start_server(lambda r, w: callback(SocketStream(r, w)),
+                                          host, port, **kwargs)
+
+
+class StreamProtocol(asyncio.BufferedProtocol):
+    __slots__ = ('callback', 'transport', 'buffers', 'current', 'filled', 'eof', 'reading_paused',
+                 'writing_paused', 'read_waiter', 'drain_waiter', 'closed')
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.transport = None
+        # double buffering: the transport fills one buffer while the
+        # view returned by recv() on the other one is being consumed
+        self.buffers = [memoryview(bytearray(BUFFER_SIZE)),
+                        memoryview(bytearray(BUFFER_SIZE))]
+        self.current = 0
+        self.filled = 0
+        self.eof = False
+        self.reading_paused = False
+        self.writing_paused = False
+        self.read_waiter = None
+        self.drain_waiter = None
+        self.closed = asyncio.get_running_loop().create_future()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if self.callback:
+            asyncio.create_task(self.callback(BufferedSocketStream(transport, self)))
+
+    def get_buffer(self, sizehint):
+        return self.buffers[self.current][self.filled:]
+
+    def buffer_updated(self, nbytes):
+        self.filled += nbytes
+        if self.filled == BUFFER_SIZE:
+            self.transport.pause_reading()
+            self.reading_paused = True
+        self.wakeup_reader()
+
+    def eof_received(self):
+        self.eof = True
+        self.wakeup_reader()
+
+    def connection_lost(self, exc):
+        self.eof = True
+        self.wakeup_reader()
+        self.resume_writing()
+        if not self.closed.done():
+            self.closed.set_result(None)
+
+    def pause_writing(self):
+        self.writing_paused = True
+
+    def resume_writing(self):
+        self.writing_paused = False
+        if self.drain_waiter and not self.drain_waiter.done():
+            self.drain_waiter.set_result(None)
+
+    def wakeup_reader(self):
+        if self.read_waiter and not self.read_waiter.done():
+            self.read_waiter.set_result(None)
+
+    async def read(self):
+        while not self.filled and not self.eof:
+            self.read_waiter = asyncio.get_running_loop().create_future()
+            await self.read_waiter
+        if not self.filled:
+            return b''
+
+        msg = self.buffers[self.current][:self.filled]
+        self.current ^= 1
+        self.filled = 0
+        if self.reading_paused:
+            self.reading_paused = False
+            self.transport.resume_reading()
+        return msg
+
+    async def drain(self):
+        if self.transport.is_closing():
+            raise ConnectionResetError('Connection lost')
+        if self.writing_paused:
+            self.drain_waiter = asyncio.get_running_loop().create_future()
+            await self.drain_waiter
+
+
+class BufferedSocketStream:
+    # recv() returns a memoryview into a reused buffer, which stays
+    # valid until the next recv() call
+    __slots__ = ('transport', 'protocol', 'closed')
+
+    def __init__(self, transport, protocol):
+        self.transport = transport
+        self.protocol = protocol
+        self.closed = False
+
+    async def send(self, msg):
+        if isinstance(msg, memoryview):
+            msg = bytes(msg)
+        self.transport.write(msg)
+        await self.protocol.drain()
+
+    async def recv(self):
+        return await self.protocol.read()
+
+    async def close(self):
+        self.closed = True
+        self.transport.close()
+        await self.protocol.closed
+
+    def get_extra_info(self, name):
+        return self.transport.get_extra_info(name)
+
+    @staticmethod
+    async def open_connection(host=None, port=None, **kwargs):
+        try:
+            loop = asyncio.get_running_loop()
+            transport, protocol = await loop.create_connection(StreamProtocol, host, port, **kwargs)
+            return BufferedSocketStream(transport, protocol)
+        except Exception as e:
+            logger.exception(e)
             return None
 
+    @staticmethod
+    async def start_server(callback, host=None, port=None, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.create_server(lambda: StreamProtocol(callback), host, port, **kwargs)
+
+
+STREAM_TYPES = {
+    'default': SocketStream,
+    'buffered': BufferedSocketStream,
+}
+
 
 PIPE_EXCEPTION = (RuntimeError, TimeoutError, ConnectionResetError,
                   websockets.ConnectionClosedError,
@@ -48,30 +212,63 @@ PIPE_EXCEPTION = (RuntimeError, TimeoutError, ConnectionResetError,
 
 
 class Pipe:
-    def __init__(self, sock1, sock2):
-        self.logger = get_logger(__name__)
+    # sock1 faces the client, bytes from sock1 to sock2 are counted as 'up'
+    __slots__ = ('sock1', 'sock2', 'kind', 'idle_timeout', 'flow', 'timer', 'pipeing')
+
+    def __init__(self, sock1, sock2, kind='tcp', idle_timeout=0, flow=None):
         self.sock1 = sock1
         self.sock2 = sock2
+        self.kind = kind
+        self.idle_timeout = idle_timeout
+        # ShapedFlow when rate limits are on
+        self.flow = flow
+        self.timer = None
         self.pipeing = False
 
-    async def recv_and_send(self, r, w):
+    def on_idle(self):
+        logger.debug('%s pipe idle for %ss, close', self.kind, self.idle_timeout)
+        REAPED.labels(self.kind, 'idle').inc()
+        asyncio.create_task(self.close())
+
+    async def recv_and_send(self, r, w, direction):
+        counter = PIPE_BYTES.labels(self.kind, direction)
         while self.pipeing:
             try:
                 msg = await r.recv()
+                if self.timer:
+                    self.timer.touch()
                 if not len(msg):
                     await self.close()
+                counter.value += len(msg)
+                if self.flow:
+                    await self.flow.throttle(direction, len(msg))
                 await w.send(msg)
             except PIPE_EXCEPTION as e:
                 await self.close()
-                self.logger.debug(e)
+                logger.debug(e)
             except Exception as e:
                 await self.close()
-                self.logger.exception(e)
+                logger.exception(e)
 
     async def pipe(self):
         self.pipeing = True
-        await asyncio.gather(asyncio.create_task(self.recv_and_send(self.sock1, self.sock2)),
-                             asyncio.create_task(self.recv_and_send(self.sock2, self.sock1)))
+        active = PIPES_ACTIVE.labels(self.kind)
+        active.inc()
+        if self.idle_timeout > 0:
+            self.timer = TIMERS.add(self.idle_timeout, self.on_idle)
+        # the calling task relays upstream, one extra task per pipe
+        down = asyncio.create_task(self.recv_and_send(self.sock2, self.sock1, 'down'))
+        try:
+            await self.recv_and_send(self.sock1, self.sock2, 'up')
+            await down
+        finally:
+            if not down.done():
+                down.cancel()
+            if self.timer:
+                self.timer.cancel()
+            if self.flow:
+                self.flow.close()
+            active.dec()
 
     async def close(self):
         self.pipeing = False
@@ -79,79 +276,286 @@ class Pipe:
         await self.sock2.close()
 
 
+class CoalescingWriter:
+    __slots__ = ('sock', 'delay', 'size', 'buffer', 'timer', 'lock')
+
+    def __init__(self, sock, delay, size):
+        self.sock = sock
+        self.delay = delay
+        self.size = size
+        self.buffer = bytearray()
+        self.timer = None
+        self.lock = asyncio.Lock()
+
+    async def send(self, msg):
+        COALESCE_CHUNKS.labels().inc()
+        if len(msg) >= self.size and not len(self.buffer):
+            await self.write(msg)
+            return
+
+        self.buffer.extend(msg)
+        if len(self.buffer) >= self.size or not len(msg):
+            await self.flush()
+        elif not self.timer:
+            self.timer = asyncio.get_running_loop().call_later(self.delay, self.on_timer)
+
+    def on_timer(self):
+        self.timer = None
+        asyncio.create_task(self.flush())
+
+    async def flush(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        if not len(self.buffer):
+            return
+        msg = self.buffer
+        self.buffer = bytearray()
+        try:
+            await self.write(msg)
+        except PIPE_EXCEPTION as e:
+            logger.debug(e)
+
+    async def write(self, msg):
+        async with self.lock:
+            COALESCE_FRAMES.labels().inc()
+            COALESCE_BYTES.labels().inc(len(msg))
+            await self.sock.send(msg)
+
+    async def recv(self):
+        return await self.sock.recv()
+
+    async def close(self):
+        await self.flush()
+        await self.sock.close()
+
+
+async def recv_first(sock, timeout=FAST_OPEN_WAIT):
+    try:
+        return bytes(await asyncio.wait_for(sock.recv(), timeout))
+    except asyncio.TimeoutError:
+        return b''
+
+
+def coalesce(sock, config):
+    if config.coalesce_delay > 0:
+        return CoalescingWriter(sock, config.coalesce_delay / 1000, config.coalesce_size)
+    return sock
+
+
 class DatagramHandler:
-    def __init__(self, message, future):
-        self.logger = get_logger(__name__)
-        self.message = message
-        self.future = future
+    __slots__ = ('pipe', 'key', 'addr', 'transport', 'timer')
+
+    def __init__(self, pipe, key, addr):
+        self.pipe = pipe
+        self.key = key
+        self.addr = addr
         self.transport = None
+        self.timer = TIMERS.add(UDP_IDLE_TIMEOUT, self.close)
 
     def connection_made(self, transport):
-        self.logger.debug(f'send: {self.message}')
         self.transport = transport
-        self.transport.sendto(self.message)
+
+    def sendto(self, payload):
+        self.timer.touch()
+        self.transport.sendto(payload)
 
     def datagram_received(self, data, addr):
-        self.logger.debug(f'received: {data}')
-        self.future.set_result(data)
-        self.transport.close()
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('received from %s: %s', addr, data)
+        self.timer.touch()
+        self.pipe.reply(self.key, NMP_CONNECT_OK, addr, data)
 
     def error_received(self, exc):
-        self.logger.debug(f'exception: {exc}')
-        self.future.set_result(None)
+        logger.debug('exception: %s', exc)
+        self.pipe.reply(self.key, NMP_CONNECT_FAILED, self.addr, b'')
 
     def connection_lost(self, exc):
-        self.logger.debug(f'connection lost')
+        logger.debug('connection lost')
+        if self.pipe.associations.get(self.key) is self:
+            del self.pipe.associations[self.key]
+
+    def close(self):
+        self.timer.cancel()
+        if self.transport:
+            self.transport.close()
 
 
 class DatagramPipe:
-    def __init__(self, wsock):
-        self.logger = get_logger(__name__)
+    kind = 'udp'
+
+    def __init__(self, wsock, idle_timeout=0, max_associations=MAX_UDP_ASSOCIATION):
         self.wsock = wsock
+        self.idle_timeout = idle_timeout
+        self.max_associations = max_associations
+        self.timer = None
+        # key -> DatagramHandler, in least recently used order
+        self.associations = OrderedDict()
+        self.replies = asyncio.Queue(maxsize=MAX_UDP_REPLY_QUEUE)
+
+    def on_idle(self):
+        logger.debug('%s pipe idle for %ss, close', self.kind, self.idle_timeout)
+        REAPED.labels(self.kind, 'idle').inc()
+        asyncio.create_task(self.wsock.close())
 
     async def accept(self):
         msg = await self.wsock.recv()
-        self.logger.debug(msg)
+        if self.timer:
+            self.timer.touch()
         if not len(msg):
-            self.logger.debug(f'websocket connection[{self.wsock}] closed')
+            logger.debug('websocket connection[%s] closed', self.wsock)
             return False
 
-        await self.send_and_reply(msg)
+        await self.send(msg)
         return True
 
     # -------------------------------
     # | 4 bytes | 2 bytes  |  ...   |
     # |   ip   |   port   | payload |
-    async def send_and_reply(self, msg):
-        host = socket.inet_ntoa(msg[:4])
-        port = struct.unpack('!H', msg[4:6])[0]
-        payload = msg[6:]
-        self.logger.debug(host)
-        self.logger.debug(port)
-        self.logger.debug(payload)
+    def unpack(self, msg):
+        addr = (socket.inet_ntoa(msg[:4]), struct.unpack('!H', msg[4:6])[0])
+        return addr, addr, msg[6:]
 
-        loop = asyncio.get_running_loop()
-        future = loop.create_future()
-        transport, protocol = await loop.create_datagram_endpoint(
-            lambda: DatagramHandler(payload, future), remote_addr=(host, port))
-        data = await protocol.future
-        transport.close()
-        if not data:
-            reply = struct.pack('!B', NMP_CONNECT_FAILED)
-            await self.wsock.send(msg)
-        reply = bytearray(struct.pack('!B', NMP_CONNECT_OK))
-        reply.extend(data)
-        await self.wsock.send(reply)
+    # ---------------------
+    # | 1 bytes |  ...    |
+    # |  code   | payload |
+    # as deployed clients expect it, the flow types carry the responder address
+    def pack(self, key, code, addr, data):
+        msg = bytearray(struct.pack('!B', code))
+        msg.extend(data)
+        return msg
+
+    async def send(self, msg):
+        key, addr, payload = self.unpack(msg)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('send %s to %s: %s', key, addr, payload)
+
+        handler = self.associations.get(key)
+        if handler:
+            self.associations.move_to_end(key)
+        else:
+            handler = await self.associate(key, addr)
+            if not handler:
+                self.reply(key, NMP_CONNECT_FAILED, addr, b'')
+                return
+        handler.sendto(payload)
+
+    async def associate(self, key, addr):
+        if len(self.associations) >= self.max_associations:
+            _, oldest = self.associations.popitem(last=False)
+            oldest.close()
+        try:
+            loop = asyncio.get_running_loop()
+            _, handler = await loop.create_datagram_endpoint(
+                lambda: DatagramHandler(self, key, addr), remote_addr=addr)
+        except OSError as e:
+            logger.debug('associate %s failed: %s', addr, e)
+            return None
+        self.associations[key] = handler
+        return handler
+
+    def reply(self, key, code, addr, data):
+        try:
+            self.replies.put_nowait(self.pack(key, code, addr, data))
+        except asyncio.QueueFull:
+            logger.debug('reply queue full, drop datagram from %s', addr)
+
+    async def next_reply(self):
+        return await self.replies.get()
+
+    async def send_replies(self):
+        try:
+            while True:
+                msg = await self.next_reply()
+                if self.timer:
+                    self.timer.touch()
+                await self.wsock.send(msg)
+        except PIPE_EXCEPTION as e:
+            logger.debug(e)
 
     async def pipe(self):
+        active = PIPES_ACTIVE.labels(self.kind)
+        active.inc()
+        if self.idle_timeout > 0:
+            self.timer = TIMERS.add(self.idle_timeout, self.on_idle)
+        task = asyncio.create_task(self.send_replies())
         pipeing = True
         while pipeing:
             try:
                 pipeing = await self.accept()
             except PIPE_EXCEPTION as e:
-                self.logger.debug(e)
+                logger.debug(e)
                 pipeing = False
             except Exception as e:
-                self.logger.exception(e)
+                logger.exception(e)
                 pipeing = False
+        task.cancel()
+        if self.timer:
+            self.timer.cancel()
+        for handler in list(self.associations.values()):
+            handler.close()
+        active.dec()
         await self.wsock.close()
+
+
+# -------------------------------------------------------
+# | 4 bytes | 1 bytes | 4 bytes | 2 bytes  |    ...    |
+# | flow id |  code   |   ip    |   port   |  payload  |
+# requests carry the destination address, replies the responder address
+UDP_FLOW_HEADER = struct.Struct('!IB4sH')
+
+
+class DatagramFlowPipe(DatagramPipe):
+    kind = 'flow'
+
+    def unpack(self, msg):
+        flow_id, _, ip, port = UDP_FLOW_HEADER.unpack_from(msg)
+        return flow_id, (socket.inet_ntoa(ip), port), msg[UDP_FLOW_HEADER.size:]
+
+    def pack(self, key, code, addr, data):
+        msg = bytearray(UDP_FLOW_HEADER.pack(key, code, socket.inet_aton(addr[0]), addr[1]))
+        msg.extend(data)
+        return msg
+
+
+# ----------------------------------------------------
+# | 2 bytes |      ...      | 2 bytes |      ...      |
+# | length  | flow datagram | length  | flow datagram | ...
+UDP_BATCH_LENGTH = struct.Struct('!H')
+# a frame takes what was queued while the previous one was sent, up to this size
+MAX_UDP_BATCH = 2 ** 16
+
+
+def pack_batch(msgs):
+    frame = bytearray()
+    for msg in msgs:
+        frame.extend(UDP_BATCH_LENGTH.pack(len(msg)))
+        frame.extend(msg)
+    return frame
+
+
+def unpack_batch(frame):
+    view = memoryview(frame)
+    offset = 0
+    while offset + UDP_BATCH_LENGTH.size <= len(view):
+        size = UDP_BATCH_LENGTH.unpack_from(view, offset)[0]
+        offset += UDP_BATCH_LENGTH.size
+        yield view[offset:offset + size]
+        offset += size
+
+
+class DatagramBatchPipe(DatagramFlowPipe):
+    # flow datagrams, several per websocket message in both directions
+    async def send(self, msg):
+        for datagram in unpack_batch(msg):
+            if len(datagram) >= UDP_FLOW_HEADER.size:
+                await super().send(datagram)
+
+    async def next_reply(self):
+        batch = [await self.replies.get()]
+        size = len(batch[0])
+        while not self.replies.empty() and size < MAX_UDP_BATCH:
+            msg = self.replies.get_nowait()
+            batch.append(msg)
+            size += len(msg)
+        return pack_batch(batch)
@@ -5,12 +5,27 @@ SOCK_V5 = 5
 RSV = 0
 ATYP_IP_V4 = 1
 ATYP_DOMAINNAME = 3
+ATYP_IP_V6 = 4
 CMD_CONNECT = 1
+CMD_UDP_ASSOCIATE = 3
 IMPLEMENTED_METHODS = (2, 0)
 
 # nmp
 NMP_CONNECT_OK = 0
 NMP_CONNECT_FAILED = 1
+# over the server's admission limits, retry later or elsewhere
+NMP_CONNECT_OVERLOADED = 2
 NMP_TCP_PIPE_IP = ATYP_IP_V4
 NMP_TCP_PIPE_DOMAIN = ATYP_DOMAINNAME
 NMP_UDP_PIPE_IP = 4
+NMP_MUX_PIPE = 5
+NMP_UDP_FLOW = 6
+NMP_TCP_PIPE_FAST = 7
+NMP_UDP_BATCH = 8
+
+# mux
+MUX_OPEN = 1
+MUX_REPLY = 2
+MUX_DATA = 3
+MUX_CLOSE = 4
+MUX_WINDOW = 5
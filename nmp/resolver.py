@@ -0,0 +1,150 @@
+#!/bin/env python3
+
+import asyncio
+import ipaddress
+import socket
+import time
+from collections import OrderedDict
+from nmp.log import get_logger
+from nmp.metrics import DNS_CACHE_ENTRIES, DNS_LOOKUPS, DNS_RESOLVE_SECONDS
+
+logger = get_logger(__name__)
+
+# getaddrinfo doesn't report record ttls, cache everything for a fixed time
+DNS_TTL = 60
+DNS_NEGATIVE_TTL = 5
+DNS_CACHE_SIZE = 2 ** 10
+# RFC 8305 connection attempt delay
+HAPPY_EYEBALLS_DELAY = 0.25
+
+
+def ip_family(host):
+    try:
+        return socket.AF_INET6 if ipaddress.ip_address(host).version == 6 else socket.AF_INET
+    except ValueError:
+        return None
+
+
+def interleave(infos):
+    # alternate address families, keeping the preferred one first
+    families = OrderedDict()
+    for family, _, _, _, sockaddr in infos:
+        addrs = families.setdefault(family, [])
+        if sockaddr[0] not in addrs:
+            addrs.append(sockaddr[0])
+    result = []
+    queues = [[(family, addr) for addr in addrs] for family, addrs in families.items()]
+    while any(queues):
+        for queue in queues:
+            if queue:
+                result.append(queue.pop(0))
+    return result
+
+
+async def connect_address(family, addr, port):
+    loop = asyncio.get_running_loop()
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        sock.setblocking(False)
+        await loop.sock_connect(sock, (addr, port))
+        return sock
+    except BaseException:
+        sock.close()
+        raise
+
+
+async def happy_eyeballs(addrs, port, delay=HAPPY_EYEBALLS_DELAY):
+    # start the next attempt when the previous one fails or after delay,
+    # the first connected socket wins
+    addrs = iter(addrs)
+    pending = set()
+    winner = None
+    error = None
+    try:
+        while not winner:
+            addr = next(addrs, None)
+            if addr:
+                pending.add(asyncio.create_task(connect_address(*addr, port)))
+            if not pending:
+                raise error or OSError(f'no address to connect port {port}')
+            done, pending = await asyncio.wait(pending, timeout=delay if addr else None,
+                                               return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception():
+                    error = task.exception()
+                elif not winner:
+                    winner = task.result()
+                else:
+                    task.result().close()
+        return winner
+    finally:
+        for task in pending:
+            task.cancel()
+        for result in await asyncio.gather(*pending, return_exceptions=True):
+            if isinstance(result, socket.socket):
+                result.close()
+
+
+class Resolver:
+    def __init__(self, ttl=DNS_TTL, negative_ttl=DNS_NEGATIVE_TTL, size=DNS_CACHE_SIZE):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.size = size
+        # host -> (expire time, [(family, addr)] or None)
+        self.cache = OrderedDict()
+        # host -> lookup task shared by concurrent resolves
+        self.inflight = {}
+
+    async def resolve(self, host):
+        family = ip_family(host)
+        if family:
+            return [(family, host)]
+
+        host = host.lower()
+        entry = self.cache.get(host)
+        if entry and entry[0] > time.monotonic():
+            self.cache.move_to_end(host)
+            DNS_LOOKUPS.labels('hit' if entry[1] else 'negative').inc()
+            return entry[1]
+
+        task = self.inflight.get(host)
+        if task:
+            DNS_LOOKUPS.labels('shared').inc()
+        else:
+            DNS_LOOKUPS.labels('miss').inc()
+            task = self.inflight[host] = asyncio.create_task(self.lookup(host))
+            task.add_done_callback(lambda _: self.inflight.pop(host, None))
+        # a cancelled caller must not cancel the lookup of the others
+        return await asyncio.shield(task)
+
+    async def lookup(self, host):
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        try:
+            infos = await loop.getaddrinfo(host, None, type=socket.SOCK_STREAM)
+            addrs = interleave(infos) or None
+        except OSError as e:
+            logger.debug('resolve %s failed: %s', host, e)
+            addrs = None
+        DNS_RESOLVE_SECONDS.labels().observe(time.perf_counter() - start)
+
+        if self.size > 0:
+            ttl = self.ttl if addrs else self.negative_ttl
+            self.cache[host] = (time.monotonic() + ttl, addrs)
+            self.cache.move_to_end(host)
+            while len(self.cache) > self.size:
+                self.cache.popitem(last=False)
+            DNS_CACHE_ENTRIES.labels().set(len(self.cache))
+        return addrs
+
+    async def open_connection(self, stream, host, port):
+        addrs = await self.resolve(host)
+        if not addrs:
+            logger.warning('resolve %s failed', host)
+            return None
+        try:
+            sock = await happy_eyeballs(addrs, port)
+        except OSError as e:
+            logger.warning('connect %s:%s failed: %s', host, port, e)
+            return None
+        return await stream.open_connection(sock=sock)
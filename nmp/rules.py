@@ -0,0 +1,183 @@
+#!/bin/env python3
+
+'''
+Rule files, one rule per line, '#' starts a comment:
+
+   direct 10.0.0.0/8
+   direct example.cn
+   proxy ads.example.cn
+   192.168.0.0/16
+
+A bare target means direct. CIDRs match by longest prefix, domains by
+longest suffix on label boundaries (example.cn matches www.example.cn).
+Anything unmatched goes through the tunnel. Domains are not resolved
+locally, so only ip literals are checked against CIDR rules.
+'''
+
+import ipaddress
+import socket
+from collections import OrderedDict
+from nmp.log import get_logger
+from nmp.metrics import ROUTE_DECISIONS
+from nmp.pipe import STREAM_TYPES
+
+logger = get_logger(__name__)
+
+RULE_DIRECT = 'direct'
+RULE_PROXY = 'proxy'
+RULE_ACTIONS = (RULE_DIRECT, RULE_PROXY)
+RULE_CACHE_SIZE = 2 ** 14
+
+
+class CidrTrie:
+    # multibit trie with a stride of one byte, prefixes not ending on a
+    # byte boundary are expanded over the last byte, so a lookup takes
+    # at most 4 (ipv4) or 16 (ipv6) steps. compile() inserts the shortest
+    # prefixes first and lets longer ones overwrite them.
+    # node: (byte -> action, byte -> child node)
+    def __init__(self):
+        self.rules = []
+        self.roots = None
+        self.defaults = None
+
+    def add(self, cidr, action):
+        addr, _, plen = cidr.partition('/')
+        packed = socket.inet_pton(socket.AF_INET6 if ':' in addr else socket.AF_INET, addr)
+        plen = int(plen) if plen else len(packed) * 8
+        if not 0 <= plen <= len(packed) * 8:
+            raise ValueError(f'invalid prefix length {plen}')
+        self.rules.append((plen, packed, action))
+        self.roots = None
+
+    def compile(self):
+        self.roots = {4: ({}, {}), 16: ({}, {})}
+        self.defaults = {4: None, 16: None}
+        self.rules.sort(key=lambda rule: rule[0])
+        for plen, packed, action in self.rules:
+            if plen == 0:
+                self.defaults[len(packed)] = action
+                continue
+            actions, children = self.roots[len(packed)]
+            full, rest = divmod(plen - 1, 8)
+            for byte in packed[:full]:
+                node = children.get(byte)
+                if not node:
+                    node = children[byte] = ({}, {})
+                actions, children = node
+            rest += 1
+            base = packed[full] & (0xff << (8 - rest)) & 0xff
+            actions.update(dict.fromkeys(range(base, base + (1 << (8 - rest))), action))
+
+    def lookup(self, packed):
+        if self.roots is None:
+            self.compile()
+        action = self.defaults[len(packed)]
+        actions, children = self.roots[len(packed)]
+        for byte in packed:
+            action = actions.get(byte, action)
+            node = children.get(byte)
+            if not node:
+                break
+            actions, children = node
+        return action
+
+
+class DomainTrie:
+    # reversed labels, www.example.cn is looked up as cn -> example -> www,
+    # the action of a node lives under the empty label
+    def __init__(self):
+        self.root = {}
+
+    def add(self, domain, action):
+        node = self.root
+        for label in reversed(domain.strip('.').lower().split('.')):
+            node = node.setdefault(label, {})
+        node[''] = action
+
+    def lookup(self, domain):
+        action = None
+        node = self.root
+        for label in reversed(domain.rstrip('.').lower().split('.')):
+            node = node.get(label)
+            if node is None:
+                break
+            action = node.get('', action)
+        return action
+
+
+class Router:
+    def __init__(self, cache_size=RULE_CACHE_SIZE):
+        self.cidrs = CidrTrie()
+        self.domains = DomainTrie()
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.count = 0
+
+    def add(self, action, target):
+        if action not in RULE_ACTIONS:
+            raise ValueError(f'unknown rule action {action}')
+        try:
+            network = ipaddress.ip_network(target, strict=False)
+        except ValueError:
+            # domains may start with a digit, but never hold a '/' or ':'
+            if '/' in target or ':' in target:
+                raise
+            self.domains.add(target, action)
+        else:
+            self.cidrs.add(str(network), action)
+        self.count += 1
+        self.cache.clear()
+
+    def load(self, path):
+        with open(path) as f:
+            for lineno, line in enumerate(f, 1):
+                fields = line.split('#', 1)[0].split()
+                if not fields:
+                    continue
+                try:
+                    if len(fields) == 1:
+                        self.add(RULE_DIRECT, fields[0])
+                    else:
+                        self.add(fields[0].lower(), fields[1])
+                except (OSError, ValueError) as e:
+                    logger.warning('%s:%s invalid rule %s: %s', path, lineno, line.strip(), e)
+        self.cidrs.compile()
+        self.cache.clear()
+
+    def match(self, host):
+        for family in (socket.AF_INET, socket.AF_INET6):
+            try:
+                return self.cidrs.lookup(socket.inet_pton(family, host))
+            except OSError:
+                pass
+        return self.domains.lookup(host)
+
+    def route(self, host):
+        action = self.cache.get(host)
+        if action:
+            self.cache.move_to_end(host)
+        else:
+            action = self.match(host) or RULE_PROXY
+            self.cache[host] = action
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        ROUTE_DECISIONS.labels(action).inc()
+        return action
+
+    def is_direct(self, host):
+        return self.route(host) == RULE_DIRECT
+
+
+async def open_direct(config, host, port):
+    # the --stream type of the server's upstreams, None when the connect fails
+    return await STREAM_TYPES[config.stream].open_connection(host, port)
+
+
+def load_router(config):
+    if not config.rules:
+        return None
+    router = Router(config.rule_cache_size)
+    for path in config.rules.split(','):
+        router.load(path)
+    logger.info('loaded %s routing rules', router.count)
+    return router
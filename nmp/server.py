@@ -4,64 +4,221 @@ import asyncio
 import json
 import os
 import secrets
+import ssl
 import string
 import struct
+import time
 import websockets
 from random import randint, choices
 from http import HTTPStatus
+from nmp import framing, metrics
+from nmp.admission import Admission, client_ip
+from nmp.compression import compression_options, install_policy, set_port
+from nmp.lifecycle import LIFECYCLE, tcp_listen_socket
 from nmp.log import get_logger
-from nmp.pipe import DatagramPipe, SocketStream, Pipe
-from nmp.proto import NMP_CONNECT_FAILED, NMP_CONNECT_OK, NMP_TCP_PIPE_DOMAIN, NMP_TCP_PIPE_IP, NMP_UDP_PIPE_IP
+from nmp.metrics import CONNECTS, REAPED, UPSTREAM_CONNECT_SECONDS
+from nmp.mux import MuxSession
+from nmp.pipe import FAST_OPEN_HEADER, HANDSHAKE_TIMEOUT, PIPE_EXCEPTION, STREAM_TYPES, WEBSOCKET_MAX_QUEUE, DatagramBatchPipe, DatagramFlowPipe, DatagramPipe, Pipe, coalesce
+from nmp.proto import NMP_CONNECT_FAILED, NMP_CONNECT_OK, NMP_CONNECT_OVERLOADED, NMP_MUX_PIPE, NMP_TCP_PIPE_DOMAIN, NMP_TCP_PIPE_FAST, NMP_TCP_PIPE_IP, NMP_UDP_BATCH, NMP_UDP_FLOW, NMP_UDP_PIPE_IP
+from nmp.resolver import Resolver
+from nmp.shaper import Shaper
+from nmp.timer import TIMERS
+
+logger = get_logger(__name__)
 
 
 class WebSockHandler:
-    def __init__(self, wsock):
-        self.logger = get_logger(__name__)
+    __slots__ = ('wsock', 'config', 'resolver', 'shaper', 'admission', 'stream', 'client')
+
+    def __init__(self, wsock, config, resolver, shaper, admission):
         self.wsock = wsock
+        self.config = config
+        self.resolver = resolver
+        self.shaper = shaper
+        self.admission = admission
+        self.stream = STREAM_TYPES[config.stream]
+        self.client = None
 
     # -----------------------
     # | 2 bytes |    ...    |
     # |  port   | ip/domain |
-    async def handle_stream_type(self, data):
+    def parse_request(self, data):
         port = struct.unpack('!H', data[:2])[0]
-        host = data[2:].decode()
-        self.logger.debug(host)
-        self.logger.debug(port)
-        sock = await SocketStream.open_connection(host, port)
+        return data[2:].decode(), port, b''
+
+    def parse_fast_request(self, data):
+        port, size = FAST_OPEN_HEADER.unpack_from(data)
+        offset = FAST_OPEN_HEADER.size
+        return data[offset:offset + size].decode(), port, data[offset + size:]
+
+    async def open_upstream(self, host, port, payload):
+        logger.debug('open upstream %s:%s', host, port)
+        start = time.perf_counter()
+        sock = await self.resolver.open_connection(self.stream, host, port)
+        UPSTREAM_CONNECT_SECONDS.labels().observe(time.perf_counter() - start)
+        CONNECTS.labels('server', NMP_CONNECT_OK if sock else NMP_CONNECT_FAILED).inc()
+        if sock and len(payload):
+            # first payload of a fast open request
+            await sock.send(payload)
+        return sock
+
+    async def connect_upstream(self, host, port, payload):
+        # (reply code, upstream socket or None)
+        if not await self.admission.connects.acquire():
+            CONNECTS.labels('server', NMP_CONNECT_OVERLOADED).inc()
+            return NMP_CONNECT_OVERLOADED, None
+        try:
+            sock = await self.open_upstream(host, port, payload)
+        finally:
+            self.admission.connects.release()
+        return NMP_CONNECT_OK if sock else NMP_CONNECT_FAILED, sock
+
+    def client_ip(self):
+        # once per websocket, admission and the shaper key on the same address
+        if self.client is None:
+            self.client = client_ip(self.wsock, self.admission.proxies)
+        return self.client
+
+    def shaped_flow(self):
+        if not self.shaper.enabled:
+            return None
+        return self.shaper.flow(self.client_ip())
+
+    async def handle_stream_type(self, request):
+        set_port(self.wsock, request[1])
+        code, sock = await self.connect_upstream(*request)
         if not sock:
-            reply = struct.pack('!B', NMP_CONNECT_FAILED)
+            reply = struct.pack('!B', code)
             await self.wsock.send(reply)
             await self.wsock.close()
             return
 
         reply = struct.pack('!B', NMP_CONNECT_OK)
         await self.wsock.send(reply)
-        pipe = Pipe(self.wsock, sock)
+        pipe = Pipe(coalesce(self.wsock, self.config), sock, 'tcp', self.config.idle_timeout,
+                    self.shaped_flow())
         await pipe.pipe()
 
     async def handle_datagram_type(self):
-        pipe = DatagramPipe(self.wsock)
+        pipe = DatagramPipe(self.wsock, self.config.idle_timeout)
         await pipe.pipe()
 
+    async def handle_flow_type(self):
+        pipe = DatagramFlowPipe(self.wsock, self.config.idle_timeout, self.config.udp_associations)
+        await pipe.pipe()
+
+    async def handle_batch_type(self):
+        pipe = DatagramBatchPipe(self.wsock, self.config.idle_timeout, self.config.udp_associations)
+        await pipe.pipe()
+
+    async def handle_mux_type(self):
+        session = MuxSession(self.wsock, self.handle_mux_stream)
+        LIFECYCLE.idle(self.wsock)
+        await session.run()
+
+    async def handle_mux_stream(self, stream, req):
+        LIFECYCLE.busy(self.wsock)
+        try:
+            await self.handle_mux_request(stream, req)
+        finally:
+            # the last stream is gone, a draining server closes the session now
+            if not stream.session.streams:
+                LIFECYCLE.idle(self.wsock)
+
+    async def handle_mux_request(self, stream, req):
+        rtype = struct.unpack('!B', req[:1])[0]
+        if rtype == NMP_TCP_PIPE_IP or rtype == NMP_TCP_PIPE_DOMAIN:
+            request = self.parse_request(req[1:])
+        elif rtype == NMP_TCP_PIPE_FAST:
+            request = self.parse_fast_request(req[1:])
+        else:
+            logger.error('not supported mux stream type[%s]', rtype)
+            await stream.accept(NMP_CONNECT_FAILED)
+            return
+
+        client = self.client_ip()
+        if LIFECYCLE.draining or not await self.admission.admit(client):
+            CONNECTS.labels('server', NMP_CONNECT_OVERLOADED).inc()
+            await stream.accept(NMP_CONNECT_OVERLOADED)
+            return
+        try:
+            code, sock = await self.connect_upstream(*request)
+            if not sock:
+                await stream.accept(code)
+                return
+
+            await stream.accept(NMP_CONNECT_OK)
+            pipe = Pipe(coalesce(stream, self.config), sock, 'mux', self.config.idle_timeout,
+                        self.shaped_flow())
+            await pipe.pipe()
+        finally:
+            self.admission.release(client)
+
     # -----------
     # | 1 bytes |
     # |  type   |
+    def on_request_timeout(self):
+        REAPED.labels('websocket', 'request').inc()
+        asyncio.create_task(self.wsock.close())
+
     async def handle(self):
-        req = await self.wsock.recv()
-        self.logger.debug(req)
+        # pre-warmed websockets wait for their request type for a while,
+        # so give them the idle timeout rather than the handshake timeout
+        timer = None
+        if self.config.idle_timeout > 0:
+            timer = TIMERS.add(self.config.idle_timeout, self.on_request_timeout)
+        LIFECYCLE.idle(self.wsock)
+        try:
+            req = await self.wsock.recv()
+        finally:
+            LIFECYCLE.busy(self.wsock)
+            if timer:
+                timer.cancel()
+        logger.debug(req)
         rtype = struct.unpack('!B', req[:1])[0]
-        if rtype == NMP_TCP_PIPE_IP or rtype == NMP_TCP_PIPE_DOMAIN:
-            await self.handle_stream_type(req[1:])
-        if rtype == NMP_UDP_PIPE_IP:
-            await self.handle_datagram_type()
-        else:
-            self.logger.error(f'not supported type[{rtype}]')
+        if rtype == NMP_MUX_PIPE:
+            # every mux stream is admitted on its own
+            await self.handle_mux_type()
+            return
+
+        client = self.client_ip()
+        if LIFECYCLE.draining or not await self.admission.admit(client):
+            await self.reject(rtype)
+            return
+        try:
+            if rtype == NMP_TCP_PIPE_IP or rtype == NMP_TCP_PIPE_DOMAIN:
+                await self.handle_stream_type(self.parse_request(req[1:]))
+            elif rtype == NMP_TCP_PIPE_FAST:
+                await self.handle_stream_type(self.parse_fast_request(req[1:]))
+            elif rtype == NMP_UDP_PIPE_IP:
+                # no transfer in flight, a drain closes udp pipes at once
+                LIFECYCLE.idle(self.wsock)
+                await self.handle_datagram_type()
+            elif rtype == NMP_UDP_FLOW:
+                LIFECYCLE.idle(self.wsock)
+                await self.handle_flow_type()
+            elif rtype == NMP_UDP_BATCH:
+                LIFECYCLE.idle(self.wsock)
+                await self.handle_batch_type()
+            else:
+                logger.error('not supported type[%s]', rtype)
+        finally:
+            self.admission.release(client)
+
+    async def reject(self, rtype):
+        logger.debug('overloaded or draining, reject type[%s] from %s', rtype, self.client_ip())
+        CONNECTS.labels('server', NMP_CONNECT_OVERLOADED).inc()
+        # a bare code for udp pipes too, no batch or flow message is one byte long
+        await self.wsock.send(struct.pack('!B', NMP_CONNECT_OVERLOADED))
+        await self.wsock.close()
 
 
 class NmpServer:
     def __init__(self, config):
-        self.logger = get_logger(__name__)
         self.config = config
+        self.resolver = Resolver(config.dns_ttl, size=config.dns_cache_size)
+        self.shaper = Shaper(config)
+        self.admission = Admission(config)
 
     def load_token(self):
         if os.path.exists(self.config.conf):
@@ -77,12 +234,13 @@ class NmpServer:
         return self.token == path[1:].split('/')[0]
 
     def http_handler(self, path, headers):
-        self.logger.debug(path)
+        logger.debug(path)
+        if path == f'/{self.token}/metrics':
+            return HTTPStatus.OK, {'Content-Type': metrics.CONTENT_TYPE}, metrics.render()
         if self.token_auth(path):
             return None
 
-        self.logger.warning(
-            f'auth token failed, path: {path}, headers: {headers}')
+        logger.warning('auth token failed, path: %s, headers: %s', path, headers)
         status = [HTTPStatus.NOT_FOUND,
                   HTTPStatus.INTERNAL_SERVER_ERROR,
                   HTTPStatus.OK][randint(0, 2)]
@@ -90,19 +248,63 @@ class NmpServer:
             choices(string.ascii_letters + string.digits, k=32))}
         return status, {'Content-Type': 'application/json'}, json.dumps(reply).encode('utf-8')
 
+    def ssl_context(self):
+        if not self.config.certfile:
+            return None
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(self.config.certfile, self.config.keyfile)
+        return context
+
+    def new_socket(self):
+        return tcp_listen_socket(self.config.host, self.config.port, self.config.workers > 0)
+
+    def new_frame_socket(self):
+        return tcp_listen_socket(self.config.host, self.config.frame_port, self.config.workers > 0)
+
+    async def start_frame_server(self):
+        sock = LIFECYCLE.listen_socket('nmp-frame', self.new_frame_socket)
+        server = await framing.serve(self.dispatch_frames, sock, self.ssl_context())
+        LIFECYCLE.add_server(server)
+
     async def start_server(self):
         self.load_token()
-        self.logger.info(f'### Token: {self.token} ###')
-        async with websockets.serve(self.dispatch, self.config.host, self.config.port,
-                                    process_request=self.http_handler):
+        logger.info('### Token: %s ###', self.token)
+        if self.config.frame_port:
+            await self.start_frame_server()
+        sock = LIFECYCLE.listen_socket('nmp', self.new_socket)
+        async with websockets.serve(self.dispatch, sock=sock,
+                                    ssl=self.ssl_context(),
+                                    process_request=self.http_handler,
+                                    max_queue=WEBSOCKET_MAX_QUEUE,
+                                    **compression_options(self.config)) as server:
+            # only the listener, websocket.close() would also close the connections
+            LIFECYCLE.add_server(server.server)
+            LIFECYCLE.notify_ready()
             await asyncio.Future()
 
+    async def dispatch_frames(self, fsock):
+        try:
+            path = (await asyncio.wait_for(fsock.recv(), HANDSHAKE_TIMEOUT)).decode(errors='replace')
+        except (asyncio.TimeoutError, ConnectionResetError) as e:
+            logger.debug('no token from %s: %s', fsock.remote_address, e)
+            await fsock.close()
+            return
+        if not self.token_auth(path):
+            logger.warning('auth token failed, path: %s, peer: %s', path, fsock.remote_address)
+            await fsock.close()
+            return
+        await self.dispatch(fsock, path)
+
     async def dispatch(self, wsock, path):
-        handler = WebSockHandler(wsock)
-        self.logger.debug(f'connect: {path}')
+        install_policy(wsock, self.config)
+        handler = WebSockHandler(wsock, self.config, self.resolver, self.shaper, self.admission)
+        logger.debug('connect: %s', path)
         try:
             await handler.handle()
+        except PIPE_EXCEPTION as e:
+            # pre-warmed websockets may be evicted before sending a request
+            logger.debug(e)
         except Exception as e:
-            self.logger.exception(e)
+            logger.exception(e)
             if not wsock.closed:
                 await wsock.close()
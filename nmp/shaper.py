@@ -0,0 +1,190 @@
+#!/bin/env python3
+
+'''
+Bandwidth shaping for nmp server pipes, rates in KB/s:
+
+   --rate-limit 10240         # 10 MB/s down and up, shared by every pipe
+   --rate-limit 10240,2048    # 10 MB/s down, 2 MB/s up
+   --client-rate-limit 1024   # per client ip, in addition to --rate-limit
+
+'down' is target to client, 'up' client to target. When a limit is hit
+the waiting pipes take turns by deficit round robin, so a bulk download
+gets the same share of the link as an interactive tunnel and can't
+starve it. With --workers every worker has its own limits. Behind a
+reverse proxy list it in --trusted-proxies, or every client shares the
+proxy's --client-rate-limit bucket.
+'''
+
+import asyncio
+import time
+from collections import OrderedDict
+from nmp.log import get_logger
+from nmp.metrics import THROTTLE_SECONDS, THROTTLED_BYTES
+
+logger = get_logger(__name__)
+
+DIRECTIONS = ('down', 'up')
+# bytes a waiting pipe may send per round
+DRR_QUANTUM = 2 ** 14
+# seconds of traffic a bucket holds, at least one pipe buffer
+BURST_SECONDS = 0.1
+MIN_BURST = 2 ** 16
+MIN_WAIT = 0.001
+
+
+def parse_rate(value):
+    # 'DOWN[,UP]' in KB/s -> (down, up) in bytes/s, 0 is unlimited
+    if not value:
+        return 0, 0
+    rates = [int(float(rate) * 1024) for rate in str(value).split(',')]
+    if len(rates) == 1:
+        rates.append(rates[0])
+    if len(rates) != 2 or min(rates) < 0:
+        raise ValueError(f'bad rate: {value}')
+    return tuple(rates)
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'last')
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.burst = max(rate * BURST_SECONDS, MIN_BURST)
+        self.tokens = self.burst
+        self.last = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def delay(self):
+        # until the bucket is out of debt
+        return max(-self.tokens / self.rate, MIN_WAIT)
+
+
+class FairScheduler:
+    # a pipe may send while the bucket has tokens, even more than it holds,
+    # the debt delays everybody after it. once pipes are waiting, sends of
+    # up to a quantum (interactive tunnels, like the sparse flows of
+    # fq_codel) go first, bigger ones in deficit round robin order.
+    def __init__(self, rate, direction, limit):
+        self.bucket = TokenBucket(rate)
+        # key -> [deficit, size, waiter]
+        self.sparse = OrderedDict()
+        # in round robin order
+        self.waiting = OrderedDict()
+        self.handle = None
+        self.throttled = THROTTLED_BYTES.labels(direction, limit)
+        self.seconds = THROTTLE_SECONDS.labels(direction, limit)
+
+    def take(self, size):
+        # the uncongested path, no waiting and no coroutine
+        if self.waiting or self.sparse:
+            return False
+        bucket = self.bucket
+        bucket.refill()
+        if bucket.tokens > 0:
+            bucket.tokens -= size
+            return True
+        return False
+
+    async def wait(self, key, size):
+        waiter = asyncio.get_running_loop().create_future()
+        queue = self.sparse if size <= DRR_QUANTUM else self.waiting
+        queue[key] = [0, size, waiter]
+        self.throttled.inc(size)
+        if not self.handle:
+            self.schedule()
+        start = time.monotonic()
+        try:
+            await waiter
+        finally:
+            self.seconds.inc(time.monotonic() - start)
+            # still queued when the pipe was cancelled
+            entry = queue.get(key)
+            if entry and entry[2] is waiter:
+                del queue[key]
+
+    def schedule(self):
+        loop = asyncio.get_running_loop()
+        self.handle = loop.call_later(self.bucket.delay(), self.run)
+
+    def run(self):
+        self.handle = None
+        bucket = self.bucket
+        bucket.refill()
+        while self.sparse and bucket.tokens > 0:
+            _, (_, size, waiter) = self.sparse.popitem(last=False)
+            if not waiter.done():
+                bucket.tokens -= size
+                waiter.set_result(None)
+        while self.waiting and bucket.tokens > 0:
+            key, entry = next(iter(self.waiting.items()))
+            deficit, size, waiter = entry
+            if waiter.done():
+                del self.waiting[key]
+                continue
+            deficit += DRR_QUANTUM
+            if deficit >= size:
+                del self.waiting[key]
+                bucket.tokens -= size
+                waiter.set_result(None)
+            else:
+                entry[0] = deficit
+                self.waiting.move_to_end(key)
+        if self.waiting or self.sparse:
+            self.schedule()
+
+
+class ShapedFlow:
+    __slots__ = ('shaper', 'client', 'schedulers')
+
+    def __init__(self, shaper, client, schedulers):
+        self.shaper = shaper
+        self.client = client
+        # direction -> schedulers, the client one first
+        self.schedulers = schedulers
+
+    async def throttle(self, direction, size):
+        for scheduler in self.schedulers[direction]:
+            if not scheduler.take(size):
+                await scheduler.wait(self, size)
+
+    def close(self):
+        self.shaper.release(self.client)
+
+
+class Shaper:
+    def __init__(self, config):
+        self.client_rates = parse_rate(config.client_rate_limit)
+        self.schedulers = {}
+        for direction, rate in zip(DIRECTIONS, parse_rate(config.rate_limit)):
+            if rate:
+                self.schedulers[direction] = FairScheduler(rate, direction, 'global')
+        # client ip -> [pipes, {direction: scheduler}]
+        self.clients = {}
+        self.enabled = bool(self.schedulers) or any(self.client_rates)
+
+    def flow(self, client):
+        # None when shaping is off, pipes then skip it at no cost
+        if not self.enabled:
+            return None
+        entry = self.clients.get(client)
+        if entry is None:
+            entry = self.clients[client] = [0, {
+                direction: FairScheduler(rate, direction, 'client')
+                for direction, rate in zip(DIRECTIONS, self.client_rates) if rate}]
+        entry[0] += 1
+        schedulers = {}
+        for direction in DIRECTIONS:
+            schedulers[direction] = [s for s in (entry[1].get(direction),
+                                                 self.schedulers.get(direction)) if s]
+        return ShapedFlow(self, client, schedulers)
+
+    def release(self, client):
+        entry = self.clients.get(client)
+        if entry:
+            entry[0] -= 1
+            if entry[0] <= 0:
+                del self.clients[client]
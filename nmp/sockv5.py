@@ -1,37 +1,172 @@
 #!/bin/env python3
 
 import asyncio
+import logging
 import socket
 import struct
 from nmp.connection import ConnectionPool
+from nmp.datagram import DatagramTunnel
+from nmp.lifecycle import LIFECYCLE, tcp_listen_socket
 from nmp.log import get_logger
-from nmp.pipe import Pipe, SocketStream
-from nmp.proto import ATYP_DOMAINNAME, ATYP_IP_V4, CMD_CONNECT, IMPLEMENTED_METHODS, NMP_CONNECT_OK, SOCK_V5
+from nmp.metrics import PIPES_ACTIVE, REAPED
+from nmp.pipe import STREAM_TYPES, Pipe, recv_first
+from nmp.proto import ATYP_DOMAINNAME, ATYP_IP_V4, ATYP_IP_V6, CMD_CONNECT, CMD_UDP_ASSOCIATE, IMPLEMENTED_METHODS, SOCK_V5
+from nmp.resolver import Resolver
+from nmp.rules import load_router, open_direct
+from nmp.timer import TIMERS
+
+logger = get_logger(__name__)
+
+# -------------------------------------------------------------
+# | 2 bytes | 1 bytes | 1 bytes |   4 bytes   | 2 bytes |  ...  |
+# |   rsv   |  frag   |  atyp   | ipv4/domain |  port   | data  |
+UDP_HEADER = struct.Struct('!HBB')
+UDP_IPV4_HEADER = struct.Struct('!HBB4sH')
+
+
+class UdpAssociation(asyncio.DatagramProtocol):
+    # the relay socket of one UDP ASSOCIATE, it lives as long as the
+    # control connection. datagrams go through the shared DatagramTunnel,
+    # domains are resolved here since nmp udp flows carry ipv4 addresses.
+    def __init__(self, sock, tunnel, resolver, client, idle_timeout=0):
+        self.sock = sock
+        self.tunnel = tunnel
+        self.resolver = resolver
+        # only datagrams from the client, a zero port is fixed by the first one
+        self.client = client
+        self.idle_timeout = idle_timeout
+        self.transport = None
+        self.timer = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def on_idle(self):
+        logger.debug('udp association idle for %ss, close', self.idle_timeout)
+        REAPED.labels('sockv5-udp', 'idle').inc()
+        asyncio.create_task(self.sock.close())
+
+    def datagram_received(self, data, addr):
+        if addr[0] != self.client[0] or (self.client[1] and addr[1] != self.client[1]):
+            logger.debug('drop datagram from %s, associated with %s', addr, self.client)
+            return
+        self.client = addr
+        if self.timer:
+            self.timer.touch()
+        if len(data) <= UDP_HEADER.size:
+            return
+        _, frag, atyp = UDP_HEADER.unpack_from(data)
+        if frag:
+            # no reassembly, dropping fragments is allowed by RFC 1928
+            return
+        if ATYP_IP_V4 == atyp and len(data) >= UDP_IPV4_HEADER.size:
+            _, _, _, ip, port = UDP_IPV4_HEADER.unpack_from(data)
+            self.forward(addr, socket.inet_ntoa(ip), port, data[UDP_IPV4_HEADER.size:])
+        elif ATYP_DOMAINNAME == atyp:
+            asyncio.create_task(self.resolve_and_forward(data, addr))
+
+    async def resolve_and_forward(self, data, addr):
+        offset = UDP_HEADER.size
+        size = data[offset]
+        name = data[offset + 1:offset + 1 + size].decode(errors='replace')
+        offset += 1 + size
+        if len(data) < offset + 2:
+            return
+        addrs = await self.resolver.resolve(name)
+        host = next((a for family, a in addrs or () if socket.AF_INET == family), None)
+        if not host:
+            logger.debug('no ipv4 address for %s', name)
+            return
+        port = struct.unpack_from('!H', data, offset)[0]
+        self.forward(addr, host, port, data[offset + 2:])
+
+    def forward(self, addr, host, port, payload):
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('udp %s -> %s:%s: %s', addr, host, port, payload)
+        self.tunnel.send(addr, (host, port), payload, self.reply)
+
+    def reply(self, data, from_addr, to_addr):
+        if self.transport.is_closing():
+            return
+        if self.timer:
+            self.timer.touch()
+        header = UDP_IPV4_HEADER.pack(0, 0, ATYP_IP_V4, socket.inet_aton(from_addr[0]), from_addr[1])
+        self.transport.sendto(header + data, to_addr)
+
+    async def run(self):
+        active = PIPES_ACTIVE.labels('sockv5-udp')
+        active.inc()
+        if self.idle_timeout > 0:
+            self.timer = TIMERS.add(self.idle_timeout, self.on_idle)
+        try:
+            # the association ends with the control connection
+            while len(await self.sock.recv()):
+                pass
+        except OSError as e:
+            logger.debug(e)
+        finally:
+            if self.timer:
+                self.timer.cancel()
+            self.transport.close()
+            self.tunnel.remove_flows(self.client)
+            active.dec()
+            if not self.sock.closed:
+                await self.sock.close()
 
 
 class SockHandler:
-    def __init__(self, sock, pool: ConnectionPool):
-        self.logger = get_logger(__name__)
+    __slots__ = ('sock', 'pool', 'fast_open', 'router', 'tunnel', 'resolver', 'timer', 'pipeing')
+
+    def __init__(self, sock, pool: ConnectionPool, fast_open=False, router=None, tunnel=None,
+                 resolver=None):
         self.sock = sock
         self.pool = pool
+        self.fast_open = fast_open
+        self.router = router
+        self.tunnel = tunnel
+        self.resolver = resolver
+        self.timer = None
         self.pipeing = False
 
+    def on_handshake_timeout(self):
+        logger.debug('sockv5 handshake timeout')
+        REAPED.labels('sockv5', 'handshake').inc()
+        asyncio.create_task(self.sock.close())
+
     async def handle(self):
-        r = await self.parse_ver_and_reply()
-        if not r:
-            await self.sock.close()
-            return
+        config = self.pool.config
+        if config.handshake_timeout > 0:
+            self.timer = TIMERS.add(config.handshake_timeout, self.on_handshake_timeout)
+        try:
+            r = await self.parse_ver_and_reply()
+            if not r:
+                await self.sock.close()
+                return
 
-        wsock = await self.connect_and_reply()
+            req = bytes(await self.sock.recv())
+            if len(req) >= 2 and CMD_UDP_ASSOCIATE == req[1] and self.tunnel:
+                association = await self.associate_and_reply(req)
+                wsock = None
+            else:
+                association = None
+                wsock = await self.connect_and_reply(req)
+        finally:
+            if self.timer:
+                self.timer.cancel()
+        if association:
+            await association.run()
+            return
         if not wsock:
             await self.sock.close()
             return
 
-        pipe = Pipe(self.sock, wsock)
+        pipe = Pipe(self.sock, wsock, 'sockv5', config.idle_timeout)
         await pipe.pipe()
 
     async def parse_ver_and_reply(self):
-        req = await self.sock.recv()
+        req = bytes(await self.sock.recv())
+        if len(req) < 2:
+            return False
         ver, nmethods = struct.unpack('!BB', req[0:2])
         if SOCK_V5 != ver:
             return False
@@ -43,8 +178,39 @@ class SockHandler:
 
         return False
 
-    async def connect_and_reply(self):
-        req = await self.sock.recv()
+    async def associate_and_reply(self, req):
+        # the address the client will send from, if it knows it
+        if len(req) >= 10 and ATYP_IP_V4 == req[3]:
+            client = (self.sock.get_extra_info('peername')[0], struct.unpack('!H', req[8:10])[0])
+        elif len(req) >= 22 and ATYP_IP_V6 == req[3]:
+            client = (self.sock.get_extra_info('peername')[0], struct.unpack('!H', req[20:22])[0])
+        else:
+            client = (self.sock.get_extra_info('peername')[0], 0)
+        # bound to the address the client reached us on
+        host = self.sock.get_extra_info('sockname')[0]
+        config = self.pool.config
+        try:
+            loop = asyncio.get_running_loop()
+            transport, association = await loop.create_datagram_endpoint(
+                lambda: UdpAssociation(self.sock, self.tunnel, self.resolver, client, config.idle_timeout),
+                local_addr=(host, 0))
+        except OSError as e:
+            logger.warning('udp associate failed: %s', e)
+            reply = struct.pack('!BBBB4sH', SOCK_V5, 1, 0, ATYP_IP_V4, socket.inet_aton('0.0.0.0'), 0)
+            await self.sock.send(reply)
+            return None
+
+        bind_host, bind_port = transport.get_extra_info('sockname')[:2]
+        logger.debug('udp associate %s on %s:%s', client, bind_host, bind_port)
+        family = transport.get_extra_info('socket').family
+        atyp = ATYP_IP_V6 if socket.AF_INET6 == family else ATYP_IP_V4
+        reply = struct.pack('!BBBB', SOCK_V5, 0, 0, atyp) + socket.inet_pton(family, bind_host) + struct.pack('!H', bind_port)
+        await self.sock.send(reply)
+        return association
+
+    async def connect_and_reply(self, req):
+        if len(req) < 4:
+            return None
         ver, cmd, _, atyp = struct.unpack('!BBBB', req[0:4])
         if CMD_CONNECT != cmd:
             return None
@@ -59,10 +225,24 @@ class SockHandler:
         else:
             return None
 
-        self.logger.debug(f'connect to {addr}')
+        logger.debug('connect to %s', addr)
+        # the client is done, connecting may take longer than its handshake
+        if self.timer:
+            self.timer.cancel()
         # need fix to right host ?
         nhost = struct.unpack('!I', socket.inet_aton('127.0.0.1'))[0]
-        wsock = await self.open_connection(atyp, addr, port)
+        if self.router and self.router.is_direct(addr.decode()):
+            wsock = await open_direct(self.pool.config, addr.decode(), port)
+        elif self.fast_open:
+            # the first payload rides along with the connect request,
+            # a failed connect closes the client connection later
+            reply = struct.pack("!BBBBIH", SOCK_V5, 0, 0, 1, nhost, port)
+            await self.sock.send(reply)
+            payload = await recv_first(self.sock)
+            return await self.pool.open_fast_stream(addr, port, payload)
+        else:
+            wsock = await self.open_connection(atyp, addr, port)
+
         if wsock:
             reply = struct.pack("!BBBBIH", SOCK_V5, 0, 0, 1, nhost, port)
             await self.sock.send(reply)
@@ -75,39 +255,38 @@ class SockHandler:
     async def open_connection(self, addr_type, target_host, target_port):
         req = bytearray(struct.pack("!BH", addr_type, target_port))
         req.extend(target_host)
-        self.logger.debug(req)
-        wsock = await self.pool.new_connection()
-        if not wsock:
-            return None
-
-        await wsock.send(req)
-        reply = await wsock.recv()
-        code = struct.unpack('!B', reply[:1])[0]
-        if code != NMP_CONNECT_OK:
-            self.logger.warning(f'connect refused, error code {code}')
-            await wsock.close()
-            return None
-
-        return wsock
+        logger.debug(req)
+        return await self.pool.open_stream(req)
 
 
 class SockV5Server:
     def __init__(self, config):
-        self.logger = get_logger(__name__)
         self.config = config
-        self.pool = ConnectionPool(config.endpoint, config.token)
+        self.pool = ConnectionPool(config)
+        self.tunnel = DatagramTunnel(self.pool)
+        self.resolver = Resolver(config.dns_ttl, size=config.dns_cache_size)
+        self.router = load_router(config)
+
+    def new_socket(self):
+        return tcp_listen_socket(self.config.host, self.config.port, self.config.workers > 0)
 
     async def start_server(self):
-        server = await asyncio.start_server(
-            self.dispatch, self.config.host, self.config.port)
-        async with server:
-            await server.serve_forever()
+        self.pool.start()
+        self.tunnel.start()
+        stream = STREAM_TYPES[self.config.stream]
+        sock = LIFECYCLE.listen_socket('sockv5', self.new_socket)
+        server = await stream.start_server(self.dispatch, sock=sock)
+        LIFECYCLE.add_server(server)
+        LIFECYCLE.notify_ready()
+        # closed by a drain, connections already accepted keep running
+        await asyncio.Future()
 
-    async def dispatch(self, r, w):
-        handler = SockHandler(SocketStream(r, w), self.pool)
+    async def dispatch(self, sock):
+        handler = SockHandler(sock, self.pool, self.config.fast_open, self.router, self.tunnel,
+                              self.resolver)
         try:
             await handler.handle()
         except Exception as e:
-            self.logger.warning(e)
+            logger.warning(e)
             if not handler.sock.closed:
                 await handler.sock.close()
\ No newline at end of file
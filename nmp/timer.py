@@ -0,0 +1,97 @@
+#!/bin/env python3
+
+import asyncio
+import time
+from nmp.log import get_logger
+
+logger = get_logger(__name__)
+
+TIMER_TICK = 1
+TIMER_SLOTS = 512
+
+
+class Timer:
+    __slots__ = ('wheel', 'timeout', 'callback', 'active', 'cancelled')
+
+    def __init__(self, wheel, timeout, callback):
+        self.wheel = wheel
+        self.timeout = timeout
+        self.callback = callback
+        self.active = wheel.now
+        self.cancelled = False
+
+    def touch(self):
+        self.active = self.wheel.now
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerWheel:
+    # hashed timer wheel with lazy rescheduling: touch() only records the
+    # coarse time of the last tick, a timer which has been touched since
+    # it was scheduled moves to a later slot when its slot comes up.
+    # timeouts are accurate to one tick.
+    def __init__(self, tick=TIMER_TICK, slots=TIMER_SLOTS):
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.now = time.monotonic()
+        self.position = int(self.now / tick)
+        self.count = 0
+        self.loop = None
+        self.handle = None
+
+    def add(self, timeout, callback):
+        loop = asyncio.get_running_loop()
+        if loop is not self.loop:
+            # timers of a closed loop are gone with it
+            self.loop = loop
+            self.handle = None
+            self.count = 0
+            for slot in self.slots:
+                slot.clear()
+        if not self.handle:
+            self.now = time.monotonic()
+            self.position = int(self.now / self.tick)
+            self.handle = loop.call_later(self.tick, self.advance)
+        timer = Timer(self, timeout, callback)
+        self.schedule(timer)
+        self.count += 1
+        return timer
+
+    def schedule(self, timer):
+        deadline = int((timer.active + timer.timeout) / self.tick) + 1
+        self.slots[deadline % len(self.slots)].append(timer)
+
+    def advance(self):
+        self.now = time.monotonic()
+        current = int(self.now / self.tick)
+        # after a long stall every slot is due once
+        start = max(self.position + 1, current - len(self.slots) + 1)
+        for position in range(start, current + 1):
+            self.expire(position % len(self.slots))
+        self.position = current
+        if self.count > 0:
+            self.handle = self.loop.call_later(self.tick, self.advance)
+        else:
+            self.handle = None
+
+    def expire(self, index):
+        timers = self.slots[index]
+        if not timers:
+            return
+        self.slots[index] = []
+        for timer in timers:
+            if timer.cancelled:
+                self.count -= 1
+            elif timer.active + timer.timeout > self.now:
+                self.schedule(timer)
+            else:
+                self.count -= 1
+                try:
+                    timer.callback()
+                except Exception as e:
+                    logger.exception(e)
+
+
+TIMERS = TimerWheel()
@@ -28,12 +28,21 @@
 '''
 
 import asyncio
+import logging
 import socket
 import struct
+from collections import OrderedDict
 from nmp.connection import ConnectionPool
+from nmp.datagram import DatagramTunnel
+from nmp.lifecycle import LIFECYCLE
 from nmp.log import get_logger
-from nmp.pipe import Pipe, SocketStream
-from nmp.proto import NMP_CONNECT_OK, NMP_TCP_PIPE_IP
+from nmp.metrics import REPLY_SOCKETS
+from nmp.pipe import STREAM_TYPES, UDP_IDLE_TIMEOUT, Pipe, SocketStream, recv_first
+from nmp.proto import NMP_TCP_PIPE_IP
+from nmp.rules import load_router, open_direct
+from nmp.timer import TIMERS
+
+logger = get_logger(__name__)
 
 MAX_MSG_BUF_SIZE = 2 ** 16
 MAX_IDLE_CONNECTION = 2 ** 10
@@ -45,76 +54,174 @@ IP_ORIGDSTADDR = 20
 IP_RECVORIGDSTADDR = IP_ORIGDSTADDR
 
 
-class DatagramHandler:
-    def __init__(self, pool: ConnectionPool):
-        self.logger = get_logger(__name__)
-        self.pool = pool
+# struct sockaddr_in, the family is in host byte order
+SOCKADDR_FAMILY = struct.Struct('=H')
+SOCKADDR_IN = struct.Struct('!H4s')
+ANC_BUF_SIZE = socket.CMSG_SPACE(24)
+# datagrams read per wakeup of the datagram socket
+UDP_READ_BUDGET = 2 ** 6
+# bursts overflow the default buffer long before the loop falls behind,
+# capped by net.core.rmem_max
+UDP_RCVBUF = 2 ** 22
+# bound reply sockets kept open, the least recently used is closed first
+MAX_REPLY_SOCKETS = 2 ** 10
+# replies queued while a reply socket is being registered with the loop
+MAX_REPLY_PENDING = 2 ** 6
+
+
+class ReplySocket(asyncio.DatagramProtocol):
+    # bound to an original destination, replies leave from it. while it
+    # is open the `-m socket` rule diverts datagrams for that address to
+    # it instead of the TPROXY socket, so they are forwarded from here.
+    def __init__(self, cache, addr):
+        self.cache = cache
+        self.addr = addr
+        self.transport = None
+        self.pending = []
+        self.closed = False
+        self.timer = TIMERS.add(UDP_IDLE_TIMEOUT, self.close)
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if self.closed:
+            transport.close()
+            return
+        for data, to_addr in self.pending:
+            transport.sendto(data, to_addr)
+        self.pending = None
+
+    def connection_lost(self, exc):
+        self.close()
+
+    def error_received(self, exc):
+        logger.debug('reply socket %s: %s', self.addr, exc)
+
+    def datagram_received(self, data, addr):
+        self.timer.touch()
+        self.cache.handler.forward(data, addr, self.addr)
+
+    def sendto(self, data, to_addr):
+        self.timer.touch()
+        if self.transport:
+            self.transport.sendto(data, to_addr)
+        elif len(self.pending) < MAX_REPLY_PENDING:
+            self.pending.append((bytes(data), to_addr))
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.timer.cancel()
+        self.cache.remove(self)
+        if self.transport:
+            self.transport.close()
+
 
-    @staticmethod
-    def new(pool: ConnectionPool):
-        return DatagramHandler(pool)
+class ReplySocketCache:
+    # spoofed source address -> ReplySocket, in lru order
+    def __init__(self, handler, size=MAX_REPLY_SOCKETS):
+        self.handler = handler
+        self.size = size
+        self.sockets = OrderedDict()
+
+    def new_socket(self, addr):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.setsockopt(socket.SOL_IP, IP_TRANSPARENT, 1)
+            sock.bind(addr)
+            sock.setblocking(False)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def get(self, addr):
+        reply_sock = self.sockets.get(addr)
+        if reply_sock:
+            self.sockets.move_to_end(addr)
+            REPLY_SOCKETS.labels('hit').inc()
+            return reply_sock
+        while len(self.sockets) >= self.size:
+            _, oldest = self.sockets.popitem(last=False)
+            REPLY_SOCKETS.labels('evict').inc()
+            oldest.close()
+        try:
+            sock = self.new_socket(addr)
+        except OSError as e:
+            logger.warning('fail to bind reply socket %s: %s', addr, e)
+            return None
+        REPLY_SOCKETS.labels('miss').inc()
+        reply_sock = self.sockets[addr] = ReplySocket(self, addr)
+        asyncio.create_task(self.open(reply_sock, sock))
+        return reply_sock
+
+    async def open(self, reply_sock, sock):
+        try:
+            loop = asyncio.get_running_loop()
+            await loop.create_datagram_endpoint(lambda: reply_sock, sock=sock)
+        except OSError as e:
+            logger.warning('fail to open reply socket %s: %s', reply_sock.addr, e)
+            sock.close()
+            reply_sock.close()
+
+    def remove(self, reply_sock):
+        if self.sockets.get(reply_sock.addr) is reply_sock:
+            del self.sockets[reply_sock.addr]
+
+    def close(self):
+        for reply_sock in list(self.sockets.values()):
+            reply_sock.close()
+
+
+class DatagramHandler:
+    # one per server, datagrams are queued on their tunnel flow as they come
+    def __init__(self, tunnel: DatagramTunnel):
+        self.tunnel = tunnel
+        self.replies = ReplySocketCache(self)
 
     def get_dst_addr(self, anc):
         for cmsg_level, cmsg_type, cmsg_data in anc:
             if cmsg_level == socket.SOL_IP and cmsg_type == IP_ORIGDSTADDR:
-                family, port = struct.unpack('=HH', cmsg_data[0:4])
-                port = socket.htons(port)
+                family = SOCKADDR_FAMILY.unpack_from(cmsg_data)[0]
                 if family != socket.AF_INET:
-                    self.logger.error(f'unsupported socket type {family}')
+                    logger.error('unsupported socket type %s', family)
                     return None
-                ip = socket.inet_ntop(family, cmsg_data[4:8])
-                return ip, port
-        self.logger.error('fail to get datagram dst addr')
+                port, ip = SOCKADDR_IN.unpack_from(cmsg_data, SOCKADDR_FAMILY.size)
+                return socket.inet_ntoa(ip), port
+        logger.error('fail to get datagram dst addr')
         return None
 
-    async def received(self, data, anc, from_addr,):
+    def received(self, data, anc, from_addr):
         to_addr = self.get_dst_addr(anc)
-        self.logger.debug(from_addr)
-        self.logger.debug(to_addr)
-        self.logger.debug(data)
         if not to_addr:
             return
-        reply = await self.forward_and_recv(data, to_addr)
-        if reply:
-            await self.reply(reply, to_addr, from_addr)
+        self.forward(data, from_addr, to_addr)
 
-    async def forward_and_recv(self, data, addr):
-        wsock = await self.pool.open_connection()
-        if not wsock:
-            return
-        self.logger.debug(addr)
-        msg = bytearray(socket.inet_aton(addr[0]))
-        msg.extend(struct.pack('!H', addr[1]))
-        msg.extend(data)
-        self.logger.debug(msg)
-        await wsock.send(msg)
-        reply = await wsock.recv()
-        await self.pool.close_connection(wsock)
-        statu = struct.unpack('!B', reply[:1])[0]
-        if statu != NMP_CONNECT_OK:
-            self.logger.warning(
-                f'forward message failed, addr={addr}, error={statu}')
-            return None
+    def forward(self, data, from_addr, to_addr):
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('received %s -> %s: %s', from_addr, to_addr, data)
+        self.tunnel.send(from_addr, to_addr, data, self.reply)
 
-        return reply[1:]
+    def reply(self, data, from_addr, to_addr):
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('reply %s -> %s: %s', from_addr, to_addr, data)
+        reply_sock = self.replies.get(from_addr)
+        if reply_sock:
+            reply_sock.sendto(data, to_addr)
 
-    async def reply(self, data, from_addr, to_addr):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        sock.setsockopt(socket.SOL_IP, IP_TRANSPARENT, 1)
-        self.logger.debug(from_addr)
-        self.logger.debug(to_addr)
-        self.logger.debug(data)
-        sock.bind(from_addr)
-        sock.sendto(data, to_addr)
-        sock.close()
+    def close(self):
+        self.replies.close()
 
 
 class StreamHandler:
-    def __init__(self, sock: SocketStream, pool: ConnectionPool):
-        self.logger = get_logger(__name__)
+    __slots__ = ('sock', 'pool', 'fast_open', 'router')
+
+    def __init__(self, sock: SocketStream, pool: ConnectionPool, fast_open=False, router=None):
         self.sock = sock
         self.pool = pool
+        self.fast_open = fast_open
+        self.router = router
 
     async def handle(self):
         wsock = await self.open_remote_connection()
@@ -122,96 +229,115 @@ class StreamHandler:
             await self.sock.close()
             return
 
-        pipe = Pipe(self.sock, wsock)
+        pipe = Pipe(self.sock, wsock, 'tproxy', self.pool.config.idle_timeout)
         await pipe.pipe()
 
     def get_dst_addr(self):
-        return self.sock.writer.get_extra_info('sockname')
+        return self.sock.get_extra_info('sockname')
 
     async def open_remote_connection(self):
         host, port = self.get_dst_addr()
-        self.logger.debug(host)
-        self.logger.debug(port)
+        logger.debug('open remote %s:%s', host, port)
+        if self.router and self.router.is_direct(host):
+            return await open_direct(self.pool.config, host, port)
+        if self.fast_open:
+            payload = await recv_first(self.sock)
+            return await self.pool.open_fast_stream(host.encode(), port, payload)
+
         req = bytearray(struct.pack("!BH", NMP_TCP_PIPE_IP, port))
         req.extend(host.encode())
-        self.logger.debug(req)
-        wsock = await self.pool.new_connection()
-        if not wsock:
-            return None
-
-        await wsock.send(req)
-        reply = await wsock.recv()
-        code = struct.unpack('!B', reply[:1])[0]
-        if code != NMP_CONNECT_OK:
-            self.logger.warning(f'connect refused, error code {code}')
-            await wsock.close()
-            return None
-
-        return wsock
+        logger.debug(req)
+        return await self.pool.open_stream(req)
 
 
 class TransparentServer:
     def __init__(self, config):
-        self.logger = get_logger(__name__)
         self.config = config
         self.stream_sock = None
+        self.stream_server = None
         self.datagram_sock = None
-        self.pool = ConnectionPool(config.endpoint, config.token)
+        self.pool = ConnectionPool(config)
+        self.tunnel = DatagramTunnel(self.pool)
+        self.handler = self.new_datagram_handler()
+        self.router = load_router(config)
 
     def new_datagram_socket(self):
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.config.workers > 0:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         sock.setsockopt(socket.SOL_IP, IP_TRANSPARENT, 1)
         sock.setsockopt(socket.SOL_IP, IP_RECVORIGDSTADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UDP_RCVBUF)
         sock.bind((self.config.host, self.config.port))
         return sock
 
+    def new_datagram_handler(self):
+        return DatagramHandler(self.tunnel)
+
     def datagram_handler(self):
-        data, anc, flags, from_addr = self.datagram_sock.recvmsg(
-            MAX_MSG_BUF_SIZE, socket.CMSG_SPACE(24))
-        self.logger.debug(f'recieved anc: {anc}')
-        asyncio.create_task(DatagramHandler
-                            .new(self.pool)
-                            .received(data, anc, from_addr))
-
-    async def start_datagram_server(self):
-        self.datagram_sock = self.new_datagram_socket()
+        # drain the socket up to a budget, one loop iteration per wakeup
+        # is too expensive at high packet rates
+        sock = self.datagram_sock
+        received = self.handler.received
+        for _ in range(UDP_READ_BUDGET):
+            try:
+                data, anc, flags, from_addr = sock.recvmsg(MAX_MSG_BUF_SIZE, ANC_BUF_SIZE)
+            except (BlockingIOError, InterruptedError):
+                # drained, or the other process got it while a restart hands the socket over
+                return
+            except OSError as e:
+                logger.debug(e)
+                return
+            received(data, anc, from_addr)
+
+    def start_datagram_server(self):
+        self.datagram_sock = LIFECYCLE.listen_socket('tproxy-datagram', self.new_datagram_socket)
+        self.datagram_sock.setblocking(False)
         loop = asyncio.get_running_loop()
         loop.add_reader(self.datagram_sock, self.datagram_handler)
-        self.logger.debug('datagram server started')
-        await asyncio.Future()
+        logger.debug('datagram server started')
 
     def new_stream_socket(self):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # IPPROTO_TCP so asyncio sets TCP_NODELAY on accepted sockets
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP)
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.config.workers > 0:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         sock.setsockopt(socket.SOL_IP, IP_TRANSPARENT, 1)
         sock.bind((self.config.host, self.config.port))
         sock.listen(MAX_BACKLOG)
         return sock
 
-    async def stream_handler(self, r, w):
-        self.logger.debug(r)
-        self.logger.debug(w)
-        handler = StreamHandler(SocketStream(r, w), self.pool)
+    async def stream_handler(self, sock):
+        logger.debug(sock)
+        handler = StreamHandler(sock, self.pool, self.config.fast_open, self.router)
         try:
             await handler.handle()
         except Exception as e:
-            self.logger.exception(e)
+            logger.exception(e)
             if not handler.sock.closed:
                 await handler.sock.close()
 
     async def start_stream_server(self):
-        self.stream_sock = self.new_stream_socket()
-        server = await asyncio.start_server(self.stream_handler, sock=self.stream_sock)
-        self.logger.debug(f'stream server started {server}')
-        await asyncio.Future()
+        self.stream_sock = LIFECYCLE.listen_socket('tproxy-stream', self.new_stream_socket)
+        stream = STREAM_TYPES[self.config.stream]
+        self.stream_server = await stream.start_server(self.stream_handler, sock=self.stream_sock)
+        logger.debug('stream server started %s', self.stream_server)
 
     async def start_server(self):
-        await asyncio.gather(asyncio.create_task(self.start_stream_server()),
-                             asyncio.create_task(self.start_datagram_server()))
+        self.pool.start()
+        self.tunnel.start()
+        await self.start_stream_server()
+        self.start_datagram_server()
+        LIFECYCLE.add_server(self)
+        LIFECYCLE.notify_ready()
+        await asyncio.Future()
 
     def close(self):
-        if self.stream_sock:
-            self.stream_sock.close()
+        if self.stream_server:
+            self.stream_server.close()
         if self.datagram_sock:
+            asyncio.get_running_loop().remove_reader(self.datagram_sock)
             self.datagram_sock.close()
+        self.handler.close()
@@ -0,0 +1,137 @@
+#!/bin/env python3
+
+import asyncio
+import functools
+import os
+import signal
+import time
+from nmp import metrics
+from nmp.lifecycle import LIFECYCLE
+from nmp.log import get_logger, setup_logging, stop_listener
+
+logger = get_logger(__name__)
+
+WORKER_RESTART_DELAY = 1
+WORKER_MAX_RESTART_DELAY = 30
+WORKER_MIN_UPTIME = 10
+WORKER_STOP_TIMEOUT = 10
+# index of the process merging /metrics of all workers
+METRICS_WORKER = -1
+
+
+def worker_metrics_port(config, index):
+    return config.metrics_port + 1 + index
+
+
+class Supervisor:
+    # the master never runs an event loop, so forking from it is safe
+    def __init__(self, config, target):
+        self.config = config
+        self.target = target
+        # pid -> index
+        self.workers = {}
+        self.started = {}
+        self.delays = {}
+        self.stopping = False
+
+    def spawn(self, index):
+        pid = os.fork()
+        if pid == 0:
+            self.run_worker(index)
+        self.workers[pid] = index
+        self.started[index] = time.monotonic()
+        logger.info('worker %s started, pid %s', index, pid)
+
+    def run_worker(self, index):
+        code = 0
+        try:
+            for name in ('SIGINT', 'SIGTERM', 'SIGALRM'):
+                signal.signal(getattr(signal, name), signal.SIG_DFL)
+            signal.signal(signal.SIGUSR2, signal.SIG_IGN)
+            setup_logging(self.config.log_level, self.config.log_queue)
+            self.config.worker = index
+            if index == METRICS_WORKER:
+                LIFECYCLE.close_ready()
+                asyncio.run(self.serve_metrics())
+            else:
+                self.target(self.config)
+        except BaseException as e:
+            logger.exception(e)
+            code = 1
+        finally:
+            stop_listener()
+            os._exit(code)
+
+    async def serve_metrics(self):
+        ports = [worker_metrics_port(self.config, i) for i in range(self.config.workers)]
+        collect = functools.partial(metrics.collect_workers, '127.0.0.1', ports)
+        await metrics.start_metrics_server('127.0.0.1', self.config.metrics_port, collect, reuse_port=True)
+        await asyncio.Future()
+
+    def restart_delay(self, index):
+        delay = self.delays.get(index, WORKER_RESTART_DELAY)
+        if time.monotonic() - self.started[index] > WORKER_MIN_UPTIME:
+            delay = WORKER_RESTART_DELAY
+        # back off while a worker keeps crashing right after start
+        self.delays[index] = min(delay * 2, WORKER_MAX_RESTART_DELAY)
+        return delay
+
+    def stop(self, signum, frame):
+        if self.stopping:
+            return
+        self.stopping = True
+        logger.info('stop for signal: %s, %s workers', signal.Signals(signum).name, len(self.workers))
+        self.signal_workers(signal.SIGTERM)
+        # workers drain their pipes first
+        signal.alarm(int(self.config.drain_timeout) + WORKER_STOP_TIMEOUT)
+
+    def restart(self, signum, frame):
+        if self.stopping:
+            return
+        logger.info('restart for signal: %s', signal.Signals(signum).name)
+        # the new workers share the ports with SO_REUSEPORT, no handover
+        if LIFECYCLE.spawn(self.config.workers):
+            self.stop(signum, frame)
+
+    def kill(self, signum, frame):
+        logger.warning('%s workers still running, kill', len(self.workers))
+        self.signal_workers(signal.SIGKILL)
+
+    def signal_workers(self, signum):
+        for pid in list(self.workers):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def run(self):
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGALRM, self.kill)
+        signal.signal(signal.SIGUSR2, self.restart)
+        LIFECYCLE.release()
+        if self.config.metrics_port:
+            self.spawn(METRICS_WORKER)
+        for index in range(self.config.workers):
+            self.spawn(index)
+        # only the first workers report to a restarting supervisor
+        LIFECYCLE.close_ready()
+
+        while self.workers:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            index = self.workers.pop(pid, None)
+            if index is None:
+                continue
+            code = os.waitstatus_to_exitcode(status)
+            if self.stopping:
+                logger.info('worker %s stopped, exit code %s', index, code)
+                continue
+            delay = self.restart_delay(index)
+            logger.warning('worker %s exited, exit code %s, restart in %ss', index, code, delay)
+            time.sleep(delay)
+            if not self.stopping:
+                self.spawn(index)
+        signal.alarm(0)